@@ -2,6 +2,8 @@
 Ansible output report parser hooks
 """
 
+import bisect
+
 from systematic.log import Logger
 
 __version__ = '1.0'
@@ -15,12 +17,16 @@ class SortedDict(dict):
 
     Implementation of a sorted dictionary, sorted by list of key names in
     self.compare_fields set.
+
+    Sorted keys are cached in an index which is updated when items are added
+    or removed and sorted again only after bulk updates.
     """
     compare_fields = ()
 
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
         self.log = Logger().default_stream
+        self.__sorted_keys__ = None
 
     def __cmp__(self, other):
         """Compare with self.compare_fields
@@ -39,49 +45,105 @@ class SortedDict(dict):
         else:
             cmp(self, other)
 
-    def __iter__(self):
-        """Iterate sorted keys
+    def __sorted_keys_index__(self):
+        """Return sorted key index
 
-        Iterator for sorted dictionary keys
+        Return the cached list of sorted keys, sorting the keys only if the
+        index was invalidated. The returned list must not be modified.
         """
-        return self
+        index = getattr(self, '__sorted_keys__', None)
+        if index is None:
+            index = sorted(dict.keys(self))
+            self.__sorted_keys__ = index
+        return index
 
-    def next(self):
-        """Iterator for sorted keys
+    def __setitem__(self, key, value):
+        """Set item
 
-        Standard iterator to iterate over sorted dictionary keys
+        New keys are inserted to the sorted key index with bisect
         """
-        if not hasattr(self, '__iter_index__') or self.__iter_index__ is None:
-            self.__iter_index__ = 0
-            self.__iter_keys__ = self.keys()
+        if not dict.__contains__(self, key):
+            index = getattr(self, '__sorted_keys__', None)
+            if index is not None:
+                bisect.insort(index, key)
+        dict.__setitem__(self, key, value)
 
-        try:
-            entry = self.__iter_keys__[self.__iter_index__]
-            self.__iter_index__ += 1
-            return entry
+    def __delitem__(self, key):
+        """Delete item
 
-        except KeyError:
-            self__iter__index__ = None
-            self.__iter__keys = None
+        Deleted key is removed from the sorted key index with bisect
+        """
+        dict.__delitem__(self, key)
+        index = getattr(self, '__sorted_keys__', None)
+        if index is not None:
+            del index[bisect.bisect_left(index, key)]
 
-        except IndexError:
-            self__iter__index__ = None
-            self.__iter__keys = None
-            raise StopIteration
+    def __iter__(self):
+        """Iterate sorted keys
+
+        Iterator for sorted dictionary keys. Each call returns a new iterator
+        over a snapshot of keys, so the dictionary can be modified while
+        iterating.
+        """
+        return iter(list(self.__sorted_keys_index__()))
+
+    def update(self, *args, **kwargs):
+        """Update dictionary
+
+        Sorted key index is invalidated and sorted again when next needed
+        """
+        dict.update(self, *args, **kwargs)
+        self.__sorted_keys__ = None
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self.__sorted_keys__ = None
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self.__sorted_keys__ = None
 
     def keys(self):
         """Return keys as sorted list"""
-        return [k for k in sorted(dict.keys(self))]
+        return list(self.__sorted_keys_index__())
 
     def items(self):
         """Return items sorted by self.keys()"""
-        return [(k, self[k]) for k in self.keys()]
+        return [(k, dict.__getitem__(self, k)) for k in self.__sorted_keys_index__()]
 
     def values(self):
         """Return values sorted by self.keys()"""
-        return [self[k] for k in self.keys()]
+        return [dict.__getitem__(self, k) for k in self.__sorted_keys_index__()]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def iteritems(self):
+        for key in list(self.__sorted_keys_index__()):
+            yield key, dict.__getitem__(self, key)
+
+    def itervalues(self):
+        for key in list(self.__sorted_keys_index__()):
+            yield dict.__getitem__(self, key)
 
     def copy(self):
         """Return a new SortedDict copy"""
-        return SortedDict((k,v) for k,v in self.items())
+        value = SortedDict(self)
+        index = getattr(self, '__sorted_keys__', None)
+        if index is not None:
+            value.__sorted_keys__ = list(index)
+        return value
 
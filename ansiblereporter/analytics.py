@@ -0,0 +1,495 @@
+"""
+Columnar analytics of result output
+
+Output lines of results are split to fields once and stored to a table with
+one integer column per field. Field values are dictionary encoded: each column
+stores codes of distinct values, so filtering, grouping and counting work on
+integer columns instead of parsing output of each host again.
+
+Columns are NumPy arrays if NumPy is installed, and array module arrays
+otherwise.
+"""
+
+import gc
+import array
+import operator
+import itertools
+
+from collections import Counter
+
+from ansiblereporter import RunnerError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Typecode of array module columns, matching numpy.intc
+COLUMN_TYPECODE = 'i'
+
+# Single columns with at most this many distinct codes are counted with one
+# array scan per code instead of counting rows in Python
+COLUMN_SCAN_MAX_CODES = 64
+
+# Maximum number of distinct output lines with cached field codes
+LINE_CODES_MAX_LINES = 65536
+
+# Rows are counted with NumPy bincount, without sorting, when columns have at
+# most this many combinations of codes
+COLUMN_BINCOUNT_MAX_KEYS = 1 << 20
+
+# Columns always present in output tables
+HOST_COLUMN = 'host'
+LINE_COLUMN = 'line'
+
+
+class ValueCodes(dict):
+    """Dictionary of column values to codes
+
+    Unknown values are added with next free code when looked up. Code 0 is
+    the empty string.
+    """
+
+    def __init__(self):
+        dict.__init__(self, {'': 0})
+
+    def __missing__(self, value):
+        code = self[value] = len(self)
+        return code
+
+
+class LineCodes(dict):
+    """Dictionary of output lines to tuples of field codes
+
+    Output of hosts is mostly identical lines, so each distinct line is split
+    and encoded only once. Field values are encoded with ValueCodes of each
+    field in fields. The dictionary is cleared when it has more than
+    LINE_CODES_MAX_LINES lines, to limit memory used for output where most
+    lines are different.
+    """
+
+    def __init__(self, separator=None, maxsplit=-1):
+        dict.__init__(self)
+        self.separator = separator
+        self.maxsplit = maxsplit
+        self.fields = []
+
+    def encode(self, lines):
+        """Return columns of field codes for lines
+
+        Returns list of columns, one for each field up to the most fields in
+        lines, with field code of each line. Missing fields are code 0 (empty
+        string). Lines not seen before are split and encoded column by column.
+        """
+        rows = map(self.get, lines)
+        if None in rows:
+            missing = list(itertools.compress(lines, itertools.imap(operator.is_, rows, itertools.repeat(None))))
+            values = [line.split(self.separator, self.maxsplit) for line in missing]
+            while len(self.fields) < max(map(len, values)):
+                self.fields.append(ValueCodes())
+
+            columns = [
+                map(codes.__getitem__, column)
+                for codes, column in zip(self.fields, itertools.izip_longest(*values, fillvalue=''))
+            ]
+
+            # Row of field codes for each missing line, empty for lines without fields
+            if columns:
+                encoded = zip(*columns)
+            else:
+                encoded = [()] * len(missing)
+
+            if len(self) + len(missing) > LINE_CODES_MAX_LINES:
+                self.clear()
+            self.update(itertools.izip(missing, encoded))
+            if len(missing) == len(lines):
+                return columns
+            rows = map(self.__getitem__, lines)
+
+        width = max(map(len, rows))
+        if min(map(len, rows)) < width:
+            padding = ( 0, ) * width
+            rows = [row + padding[len(row):] for row in rows]
+        return zip(*rows)
+
+
+class SelectedColumns(dict):
+    """Columns of rows selected with a mask
+
+    Rows of each column are taken from source columns when the column is
+    first looked up, so filters only copy columns which are used.
+    """
+
+    def __init__(self, source, mask):
+        dict.__init__(self)
+        self.source = source
+        self.mask = mask
+
+    def __missing__(self, name):
+        column = self[name] = column_take(self.source[name], self.mask)
+        return column
+
+
+def column_array(values=()):
+    """Return new column array with values"""
+    return array.array(COLUMN_TYPECODE, values)
+
+
+def column_view(column):
+    """Return column for table operations
+
+    Returns NumPy view of an array module column if NumPy is available.
+    """
+    if numpy is not None and isinstance(column, array.array):
+        return numpy.frombuffer(column, dtype=numpy.intc)
+    return column
+
+
+def column_mask(column, codes):
+    """Return mask of rows with column value in codes"""
+    if numpy is not None:
+        return numpy.in1d(column, numpy.array(sorted(codes), dtype=numpy.intc))
+    return map(frozenset(codes).__contains__, column)
+
+
+def combine_masks(mask, other):
+    """Return mask of rows set in both masks"""
+    if mask is None:
+        return other
+    if numpy is not None:
+        return mask & other
+    return map(operator.and_, mask, other)
+
+
+def invert_mask(mask):
+    """Return inverted row mask"""
+    if numpy is not None:
+        return ~mask
+    return map(operator.not_, mask)
+
+
+def column_take(column, mask):
+    """Return rows of column set in mask"""
+    if numpy is not None:
+        return column[mask]
+    return column_array(itertools.compress(column, mask))
+
+
+def column_counts(columns, sizes):
+    """Count rows by column values
+
+    Returns list of (codes, count) tuples, where codes is a tuple of codes of
+    the columns.
+    """
+    if numpy is None:
+        if len(columns) == 1 and sizes[0] <= COLUMN_SCAN_MAX_CODES:
+            counts = [( ( code, ), columns[0].count(code) ) for code in range(sizes[0])]
+            return [entry for entry in counts if entry[1]]
+        if len(columns) == 1:
+            return [( ( code, ), count ) for code, count in Counter(columns[0]).items()]
+        return Counter(itertools.izip(*columns)).items()
+
+    if not len(columns[0]):
+        return []
+
+    keys = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    for column, size in zip(columns, sizes):
+        keys = keys * size + column
+    if reduce(operator.mul, sizes, 1) <= COLUMN_BINCOUNT_MAX_KEYS:
+        counts = numpy.bincount(keys)
+        keys = numpy.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        counts = numpy.bincount(inverse)
+
+    values = []
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        codes = []
+        for size in reversed(sizes):
+            key, code = divmod(key, size)
+            codes.insert(0, code)
+        values.append(( tuple(codes), count ))
+    return values
+
+
+def column_pairs(key_column, column, size):
+    """Return distinct (key, value) code pairs of two columns
+
+    Size is the number of distinct codes in column. Pairs are combined to one
+    integer key each, and returned sorted by key code and value code.
+    """
+    if numpy is None:
+        keys = sorted(set(itertools.imap(operator.add, itertools.imap(size.__mul__, key_column), column)))
+    else:
+        keys = numpy.unique(key_column.astype(numpy.int64) * size + column).tolist()
+    return map(divmod, keys, itertools.repeat(size, len(keys)))
+
+
+class OutputTable(object):
+    """Output table
+
+    Table of output lines of results, one row per line. Lines are split to
+    fields with separator (whitespace if None), with up to maxsplit splits.
+    Fields are named by fields list, or field1, field2 ... if fields is not
+    given. With fields list the last field contains rest of the line. Missing
+    fields are empty strings.
+
+    Each row also has host and line (line number starting from 1) columns.
+    Only results with status in statuses are included, if statuses is given.
+
+    Filtering returns new tables sharing dictionaries of field values.
+    """
+
+    def __init__(self, results=(), separator=None, fields=None, maxsplit=-1, statuses=None):
+        self.separator = separator
+        self.names = [HOST_COLUMN, LINE_COLUMN]
+        self.columns = {}
+        self.values = {}
+        self.codes = {}
+
+        if results is None:
+            return
+
+        # Loading creates millions of tuples but no reference cycles, so cyclic
+        # garbage collection would only scan the new objects over and over
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            self.__load__(results, separator, fields, maxsplit, statuses)
+        finally:
+            if collect:
+                gc.enable()
+
+    def __load__(self, results, separator, fields, maxsplit, statuses):
+        """Split output lines of results to columns"""
+        if fields is not None and maxsplit < 0:
+            maxsplit = max(0, len(fields) - 1)
+
+        hosts = column_array()
+        lines = column_array()
+        host_values = []
+        host_codes = {}
+        line_codes = LineCodes(separator, maxsplit)
+        field_columns = []
+        field_codes = line_codes.fields
+
+        # First row and number of rows of each distinct output. Rows of output
+        # seen before are copied from the columns instead of encoded again.
+        output_rows = {}
+
+        for result in results:
+            if statuses is not None and result.status not in statuses:
+                continue
+
+            stdout = result.stdout
+            if not stdout:
+                continue
+
+            host = host_codes.setdefault(result.host, len(host_values))
+            if host == len(host_values):
+                host_values.append(result.host)
+
+            if stdout in output_rows:
+                start, count = output_rows[stdout]
+                for column in field_columns:
+                    column.extend(column[start:start + count])
+                hosts.extend(column_array(( host, )) * count)
+                lines.extend(lines[start:start + count])
+                continue
+
+            rows = stdout.splitlines()
+            columns = line_codes.encode(rows)
+
+            while len(field_columns) < len(field_codes):
+                field_columns.append(column_array(itertools.repeat(0, len(hosts))))
+
+            output_rows[stdout] = ( len(hosts), len(rows), )
+            for column, values in zip(field_columns, columns):
+                column.extend(values)
+            for column in field_columns[len(columns):]:
+                column.extend(itertools.repeat(0, len(rows)))
+            hosts.extend(column_array(( host, )) * len(rows))
+            lines.extend(xrange(1, len(rows) + 1))
+        del line_codes, output_rows
+
+        rows = len(hosts)
+        if fields is not None:
+            if len(field_columns) > len(fields):
+                raise RunnerError('Output has more fields than field names: %s' % ', '.join(fields))
+            names = list(fields)
+            while len(field_columns) < len(names):
+                field_columns.append(column_array(itertools.repeat(0, rows)))
+                field_codes.append(ValueCodes())
+        else:
+            names = ['field%d' % (index + 1) for index in range(len(field_columns))]
+
+        self.__add_column__(HOST_COLUMN, hosts, host_codes)
+        self.__add_column__(LINE_COLUMN, lines, None)
+        for name, column, codes in zip(names, field_columns, field_codes):
+            if name in self.columns:
+                raise RunnerError('Duplicate output table column: %s' % name)
+            self.names.append(name)
+            self.__add_column__(name, column, codes)
+
+    def __add_column__(self, name, column, codes):
+        self.columns[name] = column_view(column)
+        self.codes[name] = codes
+        if codes is not None:
+            values = [None] * len(codes)
+            for value, code in codes.iteritems():
+                values[code] = value
+            self.values[name] = values
+        else:
+            self.values[name] = None
+
+    def __repr__(self):
+        return 'OutputTable %d rows: %s' % (len(self), ', '.join(self.names))
+
+    def __len__(self):
+        return len(self.columns[HOST_COLUMN])
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return self.rows()
+
+    def __column__(self, name):
+        if name not in self.codes:
+            raise RunnerError('Unknown output table column: %s' % name)
+        return self.columns[name]
+
+    def __size__(self, name):
+        """Return number of distinct codes of column"""
+        if self.values[name] is not None:
+            return len(self.values[name])
+        column = self.__column__(name)
+        return len(column) and int(max(column)) + 1 or 1
+
+    def __decoder__(self, name):
+        """Return callback decoding codes of column to values"""
+        values = self.values[name]
+        if values is None:
+            return int
+        return values.__getitem__
+
+    def __decode__(self, name, code):
+        values = self.values[name]
+        if values is None:
+            return int(code)
+        return values[code]
+
+    def __encode__(self, name, values):
+        """Return codes for values of column"""
+        if isinstance(values, (basestring, int, long)):
+            values = [values]
+        codes = self.codes[name]
+        if codes is None:
+            return [int(value) for value in values]
+        return [codes[value] for value in values if value in codes]
+
+    def __mask__(self, conditions):
+        """Return mask of rows matching all column conditions, or None without conditions"""
+        mask = None
+        for name, values in conditions.items():
+            mask = combine_masks(mask, column_mask(self.__column__(name), self.__encode__(name, values)))
+        return mask
+
+    def __select__(self, mask):
+        table = OutputTable(None, separator=self.separator)
+        table.names = list(self.names)
+        table.values = self.values
+        table.codes = self.codes
+        table.columns = SelectedColumns(self.columns, mask)
+        return table
+
+    def column(self, name):
+        """Return list of values of column"""
+        column = self.__column__(name)
+        values = self.values[name]
+        if values is None:
+            return list(column)
+        return [values[code] for code in column]
+
+    def rows(self):
+        """Iterate rows as dictionaries"""
+        columns = [self.__column__(name) for name in self.names]
+        for codes in itertools.izip(*columns):
+            yield dict((name, self.__decode__(name, code)) for name, code in zip(self.names, codes))
+
+    def filter(self, **conditions):
+        """Filter rows by column values
+
+        Keyword arguments are column names and a value or list of values. Returns
+        new table with rows matching all conditions.
+        """
+        mask = self.__mask__(conditions)
+        if mask is None:
+            return self
+        return self.__select__(mask)
+
+    def exclude(self, **conditions):
+        """Exclude rows by column values
+
+        Keyword arguments are like in filter. Returns new table without rows
+        matching all conditions.
+        """
+        mask = self.__mask__(conditions)
+        if mask is None:
+            return self
+        return self.__select__(invert_mask(mask))
+
+    def where(self, name, callback):
+        """Filter rows by callback
+
+        Callback is called once for each distinct value of column. Returns new
+        table with rows where callback returned True.
+        """
+        column = self.__column__(name)
+        values = self.values[name]
+        if values is None:
+            codes = [code for code in set(column) if callback(code)]
+        else:
+            codes = [code for code, value in enumerate(values) if callback(value)]
+        return self.__select__(column_mask(column, codes))
+
+    def count(self, *names):
+        """Count rows by column values
+
+        Returns list of (value, count) tuples sorted by descending count. With
+        more than one column name, value is a tuple of column values.
+        """
+        if not names:
+            raise RunnerError('No columns to count by')
+
+        columns = [self.__column__(name) for name in names]
+        sizes = [self.__size__(name) for name in names]
+
+        counts = []
+        for codes, count in column_counts(columns, sizes):
+            values = tuple(self.__decode__(name, code) for name, code in zip(names, codes))
+            if len(names) == 1:
+                values = values[0]
+            counts.append(( values, int(count) ))
+        counts.sort(key=lambda entry: (-entry[1], entry[0]))
+        return counts
+
+    def group(self, key, name):
+        """Group distinct column values by key column
+
+        Returns dictionary of key column values to sorted lists of distinct
+        values of name column, for example hosts by shell with
+        group('shell', 'host').
+        """
+        key_column = self.__column__(key)
+        column = self.__column__(name)
+        decode_key = self.__decoder__(key)
+        decode = self.__decoder__(name)
+        value_code = operator.itemgetter(1)
+
+        groups = {}
+        pairs = column_pairs(key_column, column, self.__size__(name))
+        for key_code, entries in itertools.groupby(pairs, operator.itemgetter(0)):
+            groups[decode_key(key_code)] = sorted(map(decode, map(value_code, entries)))
+        return groups
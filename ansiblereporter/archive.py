@@ -0,0 +1,239 @@
+"""
+SQLite archive of ansible results
+
+Results from ansible and playbook runs are stored to a local SQLite database,
+one row per result, with indexes for looking up results by host, run, module,
+status and end time over many runs.
+"""
+
+import time
+import sqlite3
+
+from ansiblereporter import RunnerError
+
+DEFAULT_ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+ARCHIVE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT,
+        started TEXT,
+        finished TEXT,
+        results INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id INTEGER NOT NULL REFERENCES runs(id),
+        resultset TEXT,
+        host TEXT,
+        task TEXT,
+        module_name TEXT,
+        module_args TEXT,
+        status TEXT,
+        rc INTEGER,
+        start TEXT,
+        end TEXT,
+        stdout TEXT,
+        stderr TEXT,
+        error TEXT
+    )""",
+    'CREATE INDEX IF NOT EXISTS results_host ON results (host)',
+    'CREATE INDEX IF NOT EXISTS results_run ON results (run_id)',
+    'CREATE INDEX IF NOT EXISTS results_module ON results (module_name)',
+    'CREATE INDEX IF NOT EXISTS results_status ON results (status)',
+    'CREATE INDEX IF NOT EXISTS results_end ON results (end)',
+)
+
+RESULT_FIELDS = (
+    'run_id', 'resultset', 'host', 'task', 'module_name', 'module_args',
+    'status', 'rc', 'start', 'end', 'stdout', 'stderr', 'error',
+)
+
+
+def format_date(value):
+    """Format datetime for archive, or None if value is None"""
+    if value is None:
+        return None
+    return value.strftime(ARCHIVE_DATE_FORMAT)
+
+
+class ResultArchive(object):
+    """Result archive
+
+    SQLite database of archived results. Results are written with write(),
+    which has the same signature as result writers, so the archive can be used
+    in runner result_writers. Results are inserted in transactions of
+    batch_size results.
+
+    If command is given, a new run is started and results are archived for the
+    run. Without command the archive can only be queried.
+
+    Raises RunnerError if the database can't be opened or written.
+    """
+
+    def __init__(self, path, command=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.run_id = None
+        self.results = 0
+        self.pending = []
+
+        try:
+            self.connection = sqlite3.connect(path)
+            self.connection.row_factory = sqlite3.Row
+            with self.connection:
+                for statement in ARCHIVE_SCHEMA:
+                    self.connection.execute(statement)
+        except sqlite3.Error, emsg:
+            raise RunnerError('Error opening result archive %s: %s' % (path, emsg))
+
+        if command is not None:
+            self.start_run(command)
+
+    def __execute__(self, statement, *args):
+        try:
+            with self.connection:
+                return self.connection.execute(statement, args)
+        except sqlite3.Error, emsg:
+            raise RunnerError('Error updating result archive %s: %s' % (self.path, emsg))
+
+    def start_run(self, command):
+        """Start a new run
+
+        Returns run id of the new run
+        """
+        self.flush()
+        cursor = self.__execute__(
+            'INSERT INTO runs (command, started) VALUES (?, ?)',
+            command,
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+        )
+        self.run_id = cursor.lastrowid
+        self.results = 0
+        return self.run_id
+
+    def write(self, result, task=None):
+        """Archive a result
+
+        Result is added to pending results, which are inserted when there are
+        batch_size pending results. If task is None, result command is used as
+        task name.
+        """
+        if self.run_id is None:
+            raise RunnerError('Result archive run was not started')
+
+        self.pending.append((
+            self.run_id,
+            result.resultset.name,
+            result.host,
+            task is not None and task or result.command,
+            result.module_name,
+            result.module_args,
+            result.status,
+            result.returncode,
+            format_date(result.start),
+            format_date(result.end),
+            result.stdout,
+            result.stderr,
+            result.status in ( 'failed', 'error', ) and result.error or None,
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert pending results in one transaction"""
+        if not self.pending:
+            return
+
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO results (%s) VALUES (%s)' % (
+                        ', '.join(RESULT_FIELDS),
+                        ', '.join('?' for field in RESULT_FIELDS),
+                    ),
+                    self.pending
+                )
+        except sqlite3.Error, emsg:
+            raise RunnerError('Error writing result archive %s: %s' % (self.path, emsg))
+
+        self.results += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        """Insert pending results, finish the run and close the database"""
+        self.flush()
+        if self.run_id is not None:
+            self.__execute__(
+                'UPDATE runs SET finished=?, results=? WHERE id=?',
+                time.strftime('%Y-%m-%d %H:%M:%S'),
+                self.results,
+                self.run_id,
+            )
+        self.connection.close()
+
+    def runs(self, limit=None):
+        """Return runs
+
+        Returns list of run dictionaries, newest first
+        """
+        statement = 'SELECT * FROM runs ORDER BY id DESC'
+        args = []
+        if limit is not None:
+            statement += ' LIMIT ?'
+            args.append(limit)
+
+        try:
+            return [dict(row) for row in self.connection.execute(statement, args)]
+        except sqlite3.Error, emsg:
+            raise RunnerError('Error reading result archive %s: %s' % (self.path, emsg))
+
+    def query(self, host=None, task=None, module_name=None, status=None, runs=None, since=None, output=False):
+        """Query archived results
+
+        Arguments
+          host: host name
+          task: task name, or command for ansible commands
+          module_name: ansible module name
+          status: result status, or list of statuses
+          runs: only results from this many latest runs
+          since: only results ended after this time ('YYYY-MM-DD HH:MM:SS')
+          output: if set, include stdout, stderr and error in results
+
+        Returns list of result dictionaries, sorted by run and host
+        """
+        fields = list(RESULT_FIELDS)
+        if not output:
+            fields = [field for field in fields if field not in ( 'stdout', 'stderr', 'error', )]
+
+        filters = []
+        args = []
+        for field, value in ( ( 'host', host ), ( 'task', task ), ( 'module_name', module_name ), ):
+            if value is not None:
+                filters.append('%s=?' % field)
+                args.append(value)
+
+        if status is not None:
+            if isinstance(status, basestring):
+                status = [status]
+            filters.append('status IN (%s)' % ', '.join('?' for value in status))
+            args.extend(status)
+
+        if runs is not None:
+            filters.append('run_id IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?)')
+            args.append(runs)
+
+        if since is not None:
+            filters.append('end>=?')
+            args.append(since)
+
+        statement = 'SELECT %s FROM results' % ', '.join(fields)
+        if filters:
+            statement += ' WHERE %s' % ' AND '.join(filters)
+        statement += ' ORDER BY run_id DESC, host, id'
+
+        try:
+            return [dict(row) for row in self.connection.execute(statement, args)]
+        except sqlite3.Error, emsg:
+            raise RunnerError('Error reading result archive %s: %s' % (self.path, emsg))
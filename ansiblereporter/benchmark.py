@@ -0,0 +1,311 @@
+"""
+Benchmarks for result processing with synthetic ansible results
+
+Synthetic contacted and dark results are generated locally, without ansible
+hosts, and processed with the real result classes. Each benchmark stage
+reports elapsed time, peak memory and resident memory of the process.
+"""
+
+import gc
+import time
+import resource
+
+from datetime import datetime, timedelta
+
+from ansiblereporter.result import RunnerResults, PlaybookResults, ResultSet, SpillResultSet, Result, \
+                                  RESULT_DATE_FORMAT
+
+BENCHMARK_START_DATE = datetime(2015, 1, 1, 12, 0, 0)
+
+SYNTHETIC_SHELLS = (
+    '/bin/bash',
+    '/bin/sh',
+    '/bin/false',
+    '/usr/sbin/nologin',
+)
+
+
+class BenchmarkRunner(object):
+    """Runner stand-in
+
+    Provides the runner attributes used by result classes, so results can
+    be loaded without ansible runners.
+    """
+    resultlist_loader = RunnerResults
+    resultset_loader = ResultSet
+    result_loader = Result
+
+    def __init__(self, result_loader=None, show_colors=False, show_facts=False,
+                 spill_threshold=None, spill_directory=None):
+        if result_loader is not None:
+            self.result_loader = result_loader
+        self.show_colors = show_colors
+        self.show_facts = show_facts
+        self.result_writers = []
+        self.spill_threshold = spill_threshold
+        self.spill_directory = spill_directory
+        if spill_threshold is not None:
+            self.resultset_loader = SpillResultSet
+
+
+def synthetic_facts(host, facts):
+    """Return synthetic ansible facts
+
+    Returns dictionary with given number of facts for host
+    """
+    data = {
+        'ansible_hostname': host.split('.')[0],
+        'ansible_fqdn': host,
+    }
+    for i in range(facts):
+        data['ansible_fact_%04d' % i] = 'value %d for %s' % (i, host)
+    return data
+
+
+def synthetic_result(host, task=0, stdout_lines=10, facts=0, failed=False):
+    """Return synthetic ansible result
+
+    Returns result for a shell command, or for setup module if facts is
+    not 0. If failed is set, the result is an unreachable host result.
+    """
+    if failed:
+        return {
+            'failed': True,
+            'msg': 'SSH encountered an unknown error during the connection to %s' % host,
+        }
+
+    start = BENCHMARK_START_DATE + timedelta(seconds=task)
+    end = start + timedelta(milliseconds=(hash(host) + task) % 5000)
+
+    if facts:
+        return {
+            'changed': False,
+            'invocation': {'module_name': 'setup', 'module_args': ''},
+            'ansible_facts': synthetic_facts(host, facts),
+        }
+
+    return {
+        'rc': task % 7 == 6 and 1 or 0,
+        'changed': True,
+        'cmd': 'task-%d' % task,
+        'start': start.strftime(RESULT_DATE_FORMAT),
+        'end': end.strftime(RESULT_DATE_FORMAT),
+        'delta': str(end - start),
+        'stdout': '\n'.join('task %d output line %d on %s' % (task, i, host) for i in range(stdout_lines)),
+        'stderr': '',
+        'invocation': {'module_name': 'shell', 'module_args': 'task-%d' % task},
+    }
+
+
+def synthetic_hosts(hosts):
+    """Return list of synthetic host names"""
+    return ['host%05d.example.com' % i for i in range(hosts)]
+
+
+def synthetic_runner_results(hosts=1000, dark=0, task=0, stdout_lines=10, facts=0):
+    """Return synthetic ansible runner results
+
+    Returns dictionary like ansible Runner.run() output, with given number of
+    contacted and dark hosts.
+    """
+    names = synthetic_hosts(hosts + dark)
+    return {
+        'contacted': dict((host, synthetic_result(host, task, stdout_lines, facts)) for host in names[:hosts]),
+        'dark': dict((host, synthetic_result(host, task, failed=True)) for host in names[hosts:]),
+    }
+
+
+def synthetic_passwd_results(hosts=1000, users=1000, distinct=False):
+    """Return synthetic 'getent passwd' runner results
+
+    Returns dictionary like ansible Runner.run() output, with passwd entries
+    for given number of users on each host. Users have different shells on
+    different hosts. If distinct is set, host name is added to user names in
+    gecos field, so all output lines are different.
+    """
+    data = synthetic_runner_results(hosts=hosts, stdout_lines=0)
+    for index, host in enumerate(synthetic_hosts(hosts)):
+        gecos = distinct and ' %s' % host or ''
+        data['contacted'][host]['stdout'] = '\n'.join(
+            'user%d:x:%d:%d:User %d%s:/home/user%d:%s' % (
+                user, 1000 + user, 1000 + user, user, gecos, user,
+                SYNTHETIC_SHELLS[(index + user) % len(SYNTHETIC_SHELLS)]
+            ) for user in range(users)
+        )
+    return data
+
+
+def synthetic_playbook_results(hosts=1000, dark=0, tasks=10, stdout_lines=10, facts=0, plays=1):
+    """Iterate synthetic playbook task results
+
+    Yields runner results for each task of each play of a playbook. If facts
+    is not 0, the first task of each play is setup with given number of facts
+    per host.
+    """
+    for play in range(plays):
+        for task in range(tasks):
+            yield synthetic_runner_results(
+                hosts=hosts,
+                dark=dark,
+                task=play * tasks + task,
+                stdout_lines=stdout_lines,
+                facts=(task == 0 and facts or 0),
+            )
+
+
+def synthetic_inventory(path, hosts=10000, groups=10):
+    """Write synthetic INI inventory
+
+    Write inventory with given number of hosts split to groups named
+    group00 etc., with one host variable for each host.
+    """
+    names = synthetic_hosts(hosts)
+    fd = open(path, 'w')
+    for group in range(groups):
+        fd.write('[group%02d]\n' % group)
+        for index in range(group, hosts, groups):
+            fd.write('%s ansible_ssh_port=%d\n' % (names[index], 22 + index % 2))
+        fd.write('\n')
+    fd.close()
+    return names
+
+
+def peak_memory():
+    """Return peak resident memory of the process in kilobytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def resident_memory():
+    """Return current resident memory of the process in kilobytes
+
+    Returns None if memory usage can't be read from /proc
+    """
+    try:
+        pages = int(open('/proc/self/statm', 'r').read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+class BenchmarkStage(object):
+    """Measured benchmark stage"""
+
+    def __init__(self, name, items, elapsed, peak_memory, memory_growth, resident_memory=None):
+        self.name = name
+        self.items = items
+        self.elapsed = elapsed
+        self.peak_memory = peak_memory
+        self.memory_growth = memory_growth
+        self.resident_memory = resident_memory
+
+    def __repr__(self):
+        if self.resident_memory is not None:
+            resident = '%8.1f MB' % (self.resident_memory / 1024.0)
+        else:
+            resident = '%11s' % '-'
+        return '%-32s %10.3fs %12.0f/s %8.1f MB %+8.1f MB %s' % (
+            self.name,
+            self.elapsed,
+            self.elapsed and self.items / self.elapsed or 0,
+            self.peak_memory / 1024.0,
+            self.memory_growth / 1024.0,
+            resident,
+        )
+
+
+class Benchmark(object):
+    """Benchmark stages
+
+    Measure callbacks as benchmark stages, collecting time and memory usage
+    of each stage to self.stages.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def measure(self, name, items, callback, *args, **kwargs):
+        """Measure a stage
+
+        Run callback with given arguments and record elapsed time, peak
+        memory and resident memory after the stage. Items is the number of
+        items processed, used for throughput.
+
+        Returns value returned by callback.
+        """
+        gc.collect()
+        memory = peak_memory()
+        start = time.time()
+        value = callback(*args, **kwargs)
+        elapsed = time.time() - start
+        peak = peak_memory()
+        gc.collect()
+
+        self.stages.append(BenchmarkStage(name, items, elapsed, peak, peak - memory, resident_memory()))
+        return value
+
+    def report(self):
+        """Return report lines"""
+        lines = ['%-32s %11s %14s %11s %11s %11s' % ('stage', 'time', 'throughput', 'peak', 'growth', 'resident')]
+        lines.extend(repr(stage) for stage in self.stages)
+        return lines
+
+
+def load_runner_results(runner, data):
+    """Load runner results with result classes"""
+    return runner.resultlist_loader(runner, data, runner.show_colors)
+
+
+def load_playbook_results(runner, tasks):
+    """Load playbook results with PlaybookResults.compute"""
+    results = PlaybookResults(runner, runner.show_colors)
+    for data in tasks:
+        results.compute(data)
+    results.sort()
+    return results
+
+
+def iterate_items(resultlist):
+    """Iterate keys and values of all results"""
+    for name in ( 'contacted', 'dark', ):
+        for result in resultlist.results[name]:
+            for key, value in result.items():
+                pass
+
+
+def iterate_host_entries(resultlist):
+    """Iterate results of all host entries in grouped_by_host"""
+    grouped = resultlist.grouped_by_host
+    for name in ( 'contacted', 'dark', ):
+        for entry in grouped[name]:
+            for result in entry['results']:
+                pass
+
+
+def parse_properties(resultlist):
+    """Parse status and delta properties of all results"""
+    for name in ( 'contacted', 'dark', ):
+        for result in resultlist.results[name]:
+            result.status
+            result.ansible_status
+            result.delta
+
+
+def format_results(resultlist, formatter):
+    """Format all results with formatter
+
+    Setup results are skipped unless runner's show_facts is set, like in
+    ansible-playbook-reporter.
+    """
+    show_facts = resultlist.runner.show_facts
+    for name in ( 'contacted', 'dark', ):
+        for result in resultlist.results[name]:
+            if result.module_name == 'setup' and not show_facts:
+                continue
+            formatter(result)
+
+
+def lookup_facts(resultlist):
+    """Look up ansible facts of all contacted hosts"""
+    facts = resultlist.results['contacted'].ansible_facts
+    for host in facts.keys():
+        facts.get(host)
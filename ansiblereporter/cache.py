@@ -0,0 +1,224 @@
+"""
+On-disk caches for ansible command results and facts
+
+Results of read-only commands are cached per host, keyed by module name,
+module arguments, remote user and a hash of host inventory variables.
+Hosts with fresh cached results are not contacted again.
+
+Ansible facts are cached per host, so playbooks can skip gathering facts
+for hosts with fresh facts.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+
+from systematic.log import Logger
+
+from ansiblereporter import RunnerError
+
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_FACTS_CACHE_TTL = 3600
+
+SAFE_FILENAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+def variables_hash(variables):
+    """Return hash for host variables
+
+    Variables which can't be encoded to json are hashed by their repr()
+    """
+    try:
+        value = json.dumps(variables, sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        value = repr(sorted(variables.items()))
+    return hashlib.sha1(value).hexdigest()
+
+
+class ResultCache(object):
+    """Result cache
+
+    Cache results to files in directory, one file per cached result. Entries
+    older than ttl seconds are not used. When there are more than size entries,
+    least recently used entries are removed by prune().
+
+    Cache read and write errors are logged and the cache is bypassed.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE):
+        self.log = Logger().default_stream
+        self.directory = os.path.expanduser(os.path.expandvars(directory))
+        self.ttl = ttl
+        self.size = size
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, (ecode, emsg):
+                raise RunnerError('Error creating cache directory %s: %s' % (self.directory, emsg))
+
+    def __key__(self, host, key):
+        return [host] + list(key)
+
+    def __path__(self, host, key):
+        digest = hashlib.sha1(json.dumps(self.__key__(host, key))).hexdigest()
+        return os.path.join(self.directory, '%s.json' % digest)
+
+    def get(self, host, key):
+        """Get cached result
+
+        Return cached result data for host and key tuple, or None if there is
+        no fresh result in cache. Expired entries are removed.
+        """
+        path = self.__path__(host, key)
+        try:
+            entry = json.load(open(path, 'r'))
+        except IOError:
+            return None
+        except ValueError:
+            self.log.debug('invalid cache entry %s' % path)
+            self.remove(path)
+            return None
+
+        if entry.get('key', None) != self.__key__(host, key):
+            return None
+
+        if time.time() - entry.get('time', 0) > self.ttl:
+            self.remove(path)
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return entry.get('result', None)
+
+    def set(self, host, key, result):
+        """Store result to cache
+
+        Result is written to a temporary file which is renamed to the cache
+        entry path.
+        """
+        path = self.__path__(host, key)
+        tmpfile = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            fd = open(tmpfile, 'w')
+            json.dump({'key': self.__key__(host, key), 'time': time.time(), 'result': result}, fd)
+            fd.close()
+            os.rename(tmpfile, path)
+
+        except (TypeError, ValueError), emsg:
+            self.log.debug('error caching result for %s: %s' % (host, emsg))
+            self.remove(tmpfile)
+        except (IOError, OSError), (ecode, emsg):
+            self.log.debug('error writing cache entry %s: %s' % (path, emsg))
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Prune cache
+
+        Remove expired entries, and least recently used entries if there are
+        more than self.size entries.
+        """
+        now = time.time()
+        entries = []
+        try:
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    continue
+        except OSError, (ecode, emsg):
+            self.log.debug('error reading cache directory %s: %s' % (self.directory, emsg))
+            return
+
+        entries.sort()
+        remove = max(0, len(entries) - self.size)
+        for i, (mtime, path) in enumerate(entries):
+            if i < remove or now - mtime > self.ttl:
+                self.remove(path)
+
+
+class FactsCache(object):
+    """Persistent ansible facts cache
+
+    Store ansible facts to directory, one json file per host. Facts are fresh
+    for ttl seconds from the file modification time.
+
+    Cache read and write errors are logged and the cache is bypassed.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_FACTS_CACHE_TTL):
+        self.log = Logger().default_stream
+        self.directory = os.path.expanduser(os.path.expandvars(directory))
+        self.ttl = ttl
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, (ecode, emsg):
+                raise RunnerError('Error creating facts cache directory %s: %s' % (self.directory, emsg))
+
+    def __path__(self, host):
+        if SAFE_FILENAME.match(host):
+            name = host
+        else:
+            if isinstance(host, unicode):
+                host = host.encode('utf-8')
+            name = hashlib.sha1(host).hexdigest()
+        return os.path.join(self.directory, '%s.json' % name)
+
+    def is_fresh(self, host):
+        """Check if cache has fresh facts for host"""
+        try:
+            return time.time() - os.stat(self.__path__(host)).st_mtime <= self.ttl
+        except OSError:
+            return False
+
+    def get(self, host):
+        """Get facts
+
+        Return cached facts for host, or None if there are no fresh facts
+        """
+        if not self.is_fresh(host):
+            return None
+
+        path = self.__path__(host)
+        try:
+            return json.load(open(path, 'r'))
+        except IOError:
+            return None
+        except ValueError:
+            self.log.debug('invalid facts cache entry %s' % path)
+            return None
+
+    def set(self, host, facts):
+        """Store facts for host"""
+        path = self.__path__(host)
+        tmpfile = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            fd = open(tmpfile, 'w')
+            json.dump(facts, fd)
+            fd.close()
+            os.rename(tmpfile, path)
+
+        except (TypeError, ValueError), emsg:
+            self.log.debug('error caching facts for %s: %s' % (host, emsg))
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+        except (IOError, OSError), (ecode, emsg):
+            self.log.debug('error writing facts cache entry %s: %s' % (path, emsg))
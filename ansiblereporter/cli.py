@@ -6,6 +6,7 @@ systematic.shell.Script classes.
 """
 
 import os
+import sys
 import threading
 import getpass
 
@@ -18,10 +19,17 @@ from ansible.constants import DEFAULT_MODULE_NAME, DEFAULT_MODULE_PATH, DEFAULT_
                               DEFAULT_SUDO_USER, active_user
 
 from ansible.errors import AnsibleError
-from ansible.inventory import Inventory
 
 from ansiblereporter import RunnerError
-from ansiblereporter.result import PlaybookRunner, AnsibleRunner
+from ansiblereporter.archive import ResultArchive
+from ansiblereporter.cache import ResultCache, FactsCache, DEFAULT_CACHE_TTL, DEFAULT_CACHE_SIZE, \
+                                 DEFAULT_FACTS_CACHE_TTL
+from ansiblereporter.encoder import JSON_ENCODER_BACKENDS, set_default_encoder
+from ansiblereporter.inventory import Inventory, InventoryError, DEFAULT_INVENTORY_CACHE_TTL
+from ansiblereporter.result import PlaybookRunner, AnsibleRunner, AsyncRunner, ShardedRunner, CompactResult, \
+                                   DEFAULT_ASYNC_CONCURRENCY
+from ansiblereporter.transport import TRANSPORTS, get_transport
+from ansiblereporter.timing import TimingStats
 
 
 DEFAULT_INVENTORY_PATHS = (
@@ -80,6 +88,12 @@ class GenericAnsibleScript(Script):
         Script.__init__(self, *args, **kwargs)
         self.runner = None
         self.mode = ''
+        self.result_writers = []
+        self.retain_results = True
+        self.timing = None
+        self.archive = None
+        self.inventory = None
+        self.hosts = None
 
     def SIGINT(self, signum, frame):
         """
@@ -96,8 +110,31 @@ class GenericAnsibleScript(Script):
         if args.inventory is None:
             self.exit(1, 'Could not detect default inventory path')
 
-        if 'pattern' in args and not Inventory(args.inventory).list_hosts(args.pattern):
-            self.exit(1, 'No hosts matched')
+        try:
+            set_default_encoder(getattr(args, 'json_encoder', None), compact=getattr(args, 'compact_json', False))
+        except RunnerError, emsg:
+            self.exit(1, emsg)
+
+        if getattr(args, 'timing_summary', False) or getattr(args, 'timing_file', None):
+            self.timing = TimingStats()
+            self.add_result_writer(self.timing)
+
+        if getattr(args, 'archive', None):
+            try:
+                self.archive = ResultArchive(args.archive, command=' '.join(sys.argv))
+            except RunnerError, emsg:
+                self.exit(1, emsg)
+            self.add_result_writer(self.archive)
+
+        try:
+            inventory = self.get_inventory(args)
+        except InventoryError, emsg:
+            self.exit(1, emsg)
+
+        if 'pattern' in args:
+            self.hosts = inventory.list_hosts(args.pattern)
+            if not self.hosts:
+                self.exit(1, 'No hosts matched')
 
         if args.ask_pass:
             args.remote_pass = getpass('Enter remote user password: ')
@@ -116,6 +153,87 @@ class GenericAnsibleScript(Script):
 
         return args
 
+    def get_inventory(self, args):
+        """Return inventory for arguments
+
+        Inventory is parsed only once and the same inventory is passed to the
+        runners, so inventory files and scripts are not parsed again. If
+        --inventory-cache was given, parsed inventory is cached to the directory.
+        """
+        if self.inventory is None:
+            self.inventory = Inventory(
+                os.path.realpath(args.inventory),
+                cache_directory=getattr(args, 'inventory_cache', None),
+                cache_ttl=getattr(args, 'inventory_cache_ttl', DEFAULT_INVENTORY_CACHE_TTL),
+            )
+        return self.inventory
+
+    def add_result_writer(self, writer):
+        """Add result writer
+
+        Writer is passed to runner as result_writers entry and receives each
+        result as it is collected. The caller must close the writer.
+
+        Set self.retain_results to False before running if results are only
+        consumed by the writers, so runner does not keep the results.
+        """
+        self.result_writers.append(writer)
+
+    def report_timing(self, args):
+        """Report task timing statistics
+
+        Show timing summary to stderr and write timing statistics file, if
+        requested with --timing-summary or --timing-file arguments.
+
+        Exits with error if writing the file failed.
+        """
+        if self.timing is None:
+            return
+
+        if getattr(args, 'timing_summary', False):
+            self.error('\n'.join(self.timing.summary()))
+
+        if getattr(args, 'timing_file', None):
+            try:
+                self.timing.write_to_file(args.timing_file, prometheus=args.timing_format == 'prometheus')
+            except RunnerError, emsg:
+                self.exit(1, emsg)
+
+    def close_archive(self):
+        """Close result archive
+
+        Insert pending results to result archive given with --archive argument
+        and finish the archived run.
+
+        Exits with error if writing the archive failed.
+        """
+        if self.archive is None:
+            return
+
+        try:
+            self.archive.close()
+        except RunnerError, emsg:
+            self.exit(1, emsg)
+
+    def get_result_loader(self, args):
+        """Return result loader for arguments
+
+        Returns CompactResult if --compact-results was given, otherwise the
+        default result_loader of self.runner_class.
+        """
+        if getattr(args, 'compact_results', False):
+            return CompactResult
+        return self.runner_class.result_loader
+
+    def get_facts_cache(self, args):
+        """Return facts cache for arguments
+
+        Returns FactsCache if --facts-cache-directory was given, otherwise None
+        """
+        if not getattr(args, 'facts_cache_directory', None):
+            return None
+        return FactsCache(args.facts_cache_directory, ttl=args.facts_cache_ttl)
+
 
 class AnsibleScript(GenericAnsibleScript):
     """Ansible script wrapper
@@ -132,6 +250,9 @@ class AnsibleScript(GenericAnsibleScript):
 
     def add_common_arguments(self):
         self.add_argument('-i', '--inventory', default=find_inventory(), help='Inventory path')
+        self.add_argument('--inventory-cache', help='Cache parsed inventory to directory')
+        self.add_argument('--inventory-cache-ttl', type=int, default=DEFAULT_INVENTORY_CACHE_TTL,
+            help='Cached dynamic inventory lifetime in seconds')
         self.add_argument('-M', '--module-path', default=DEFAULT_MODULE_PATH, help='Ansible module path')
         self.add_argument('-T', '--timeout', type=int, default=DEFAULT_TIMEOUT, help='Response timeout')
         self.add_argument('-u', '--user', default=active_user, help='Remote user')
@@ -144,6 +265,23 @@ class AnsibleScript(GenericAnsibleScript):
         self.add_argument('-k', '--ask-pass', action='store_true', help='Ask for SSH password')
         self.add_argument('-K', '--ask-sudo-pass', action='store_true', help='Ask for sudo password')
         self.add_argument('-c', '--colors', action='store_true', help='Show output with colors')
+        self.add_argument('--compact-results', action='store_true', help='Store results in compact format')
+        self.add_argument('--json-encoder', choices=JSON_ENCODER_BACKENDS, help='JSON encoder backend')
+        self.add_argument('--compact-json', action='store_true', help='Write json without indentation')
+        self.add_argument('--timing-summary', action='store_true', help='Show task timing summary')
+        self.add_argument('--timing-file', help='Task timing statistics output file')
+        self.add_argument('--timing-format', choices=('json', 'prometheus'), default='json', help='Task timing file format')
+        self.add_argument('--archive', help='Archive results to SQLite database')
+        self.add_argument('--facts-cache-directory', help='Cache ansible facts to directory')
+        self.add_argument('--facts-cache-ttl', type=int, default=DEFAULT_FACTS_CACHE_TTL, help='Cached facts lifetime in seconds')
+        self.add_argument('--cache-directory', help='Cache successful results to directory')
+        self.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='Cached result lifetime in seconds')
+        self.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Maximum number of cached results')
+        self.add_argument('--async-runner', action='store_true', help='Run commands asynchronously from one process')
+        self.add_argument('--concurrency', type=int, default=DEFAULT_ASYNC_CONCURRENCY, help='Asynchronous runner concurrency')
+        self.add_argument('--transport', choices=sorted(TRANSPORTS.keys()), default='ssh', help='Asynchronous runner transport')
+        self.add_argument('--command-timeout', type=int, help='Asynchronous runner command timeout in seconds')
+        self.add_argument('--shards', type=int, help='Split hosts to shards run in separate worker processes')
 
     def add_default_arguments(self):
         self.add_argument('-m', '--module', default=DEFAULT_MODULE_NAME, help='Ansible module name')
@@ -153,9 +291,20 @@ class AnsibleScript(GenericAnsibleScript):
     def parse_args(self):
         return GenericAnsibleScript.parse_args(self)
 
-    def run(self, args):
-        runner = self.runner_class(
+    def get_runner(self, args):
+        """Return runner for arguments
+
+        Return self.runner_class instance configured with parsed arguments,
+        AsyncRunner if --async-runner was given or ShardedRunner running
+        self.runner_class in worker processes if --shards was given.
+        """
+        if args.async_runner:
+            return self.get_async_runner(args)
+
+        kwargs = dict(
             host_list=os.path.realpath(args.inventory),
+            inventory=self.get_inventory(args),
+            run_hosts=self.hosts,
             module_path=args.module_path,
             module_name=args.module,
             module_args=args.args,
@@ -171,13 +320,82 @@ class AnsibleScript(GenericAnsibleScript):
             sudo_user=args.sudo_user,
             sudo_pass=args.sudo_pass,
             show_colors=args.colors,
+            result_loader=self.get_result_loader(args),
+            result_writers=self.result_writers,
+            retain_results=self.retain_results,
+            result_cache=self.get_result_cache(args),
+            facts_cache=self.get_facts_cache(args),
         )
 
+        if args.shards is not None and args.shards > 1:
+            return ShardedRunner(shards=args.shards, runner_class=self.runner_class, **kwargs)
+
+        return self.runner_class(**kwargs)
+
+    def get_async_runner(self, args):
+        """Return asynchronous runner for arguments
+
+        Return AsyncRunner with transport selected with --transport argument
+        """
+        if args.transport == 'ssh':
+            transport = get_transport('ssh',
+                remote_user=args.user,
+                remote_port=args.port,
+                private_key_file=args.private_key,
+                timeout=args.timeout,
+            )
+        else:
+            transport = get_transport(args.transport)
+
+        return AsyncRunner(
+            inventory=self.get_inventory(args),
+            run_hosts=self.hosts,
+            pattern=args.pattern,
+            module_name=args.module,
+            module_args=args.args,
+            transport=transport,
+            concurrency=args.concurrency,
+            command_timeout=args.command_timeout,
+            sudo=args.sudo,
+            sudo_user=args.sudo_user,
+            show_colors=args.colors,
+            result_loader=self.get_result_loader(args),
+            result_writers=self.result_writers,
+            retain_results=self.retain_results,
+            facts_cache=self.get_facts_cache(args),
+        )
+
+    def get_result_cache(self, args):
+        """Return result cache for arguments
+
+        Returns ResultCache if --cache-directory was given, otherwise None
+        """
+        if not getattr(args, 'cache_directory', None):
+            return None
+        return ResultCache(args.cache_directory, ttl=args.cache_ttl, size=args.cache_size)
+
+    def run(self, args):
+        runner = self.get_runner(args)
+
         try:
             return runner.run()
         except AnsibleError, emsg:
             raise RunnerError(emsg)
 
+    def iter_results(self, args, batch_size=None):
+        """Run ansible command and iterate results
+
+        Iterate results with AnsibleRunner.iter_results, yielding results
+        from each batch of hosts as soon as the batch is finished.
+        """
+        runner = self.get_runner(args)
+
+        try:
+            for result in runner.iter_results(batch_size=batch_size):
+                yield result
+        except AnsibleError, emsg:
+            raise RunnerError(emsg)
+
 
 class PlaybookScript(GenericAnsibleScript):
     """Playbook runner wrapper
@@ -194,6 +412,9 @@ class PlaybookScript(GenericAnsibleScript):
 
     def add_common_arguments(self):
         self.add_argument('-i', '--inventory', default=find_inventory(), help='Inventory path')
+        self.add_argument('--inventory-cache', help='Cache parsed inventory to directory')
+        self.add_argument('--inventory-cache-ttl', type=int, default=DEFAULT_INVENTORY_CACHE_TTL,
+            help='Cached dynamic inventory lifetime in seconds')
         self.add_argument('-M', '--module-path', default=DEFAULT_MODULE_PATH, help='Ansible module path')
         self.add_argument('-T', '--timeout', type=int, default=DEFAULT_TIMEOUT, help='Response timeout')
         self.add_argument('-u', '--user', default=active_user, help='Remote user')
@@ -207,7 +428,18 @@ class PlaybookScript(GenericAnsibleScript):
         self.add_argument('-K', '--ask-sudo-pass', action='store_true', help='Ask for sudo password')
         self.add_argument('-a', '--args', default=DEFAULT_MODULE_ARGS, help='Module arguments')
         self.add_argument('-c', '--colors', action='store_true', help='Show output with colors')
+        self.add_argument('--compact-results', action='store_true', help='Store results in compact format')
+        self.add_argument('--json-encoder', choices=JSON_ENCODER_BACKENDS, help='JSON encoder backend')
+        self.add_argument('--compact-json', action='store_true', help='Write json without indentation')
+        self.add_argument('--timing-summary', action='store_true', help='Show task timing summary')
+        self.add_argument('--timing-file', help='Task timing statistics output file')
+        self.add_argument('--timing-format', choices=('json', 'prometheus'), default='json', help='Task timing file format')
+        self.add_argument('--archive', help='Archive results to SQLite database')
+        self.add_argument('--facts-cache-directory', help='Cache ansible facts to directory')
+        self.add_argument('--facts-cache-ttl', type=int, default=DEFAULT_FACTS_CACHE_TTL, help='Cached facts lifetime in seconds')
         self.add_argument('--show-facts', action='store_true', help='Show ansible facts in results')
+        self.add_argument('--spill-threshold', type=int, help='Spill results to disk after this many results')
+        self.add_argument('--spill-directory', help='Directory for spilled results')
 
     def parse_args(self):
         """Parse arguments and run playbook
@@ -216,8 +448,12 @@ class PlaybookScript(GenericAnsibleScript):
         """
         return GenericAnsibleScript.parse_args(self)
 
-    def run(self, args):
-        runner = self.runner_class(
+    def get_runner(self, args):
+        """Return runner for arguments
+
+        Return self.runner_class instance configured with parsed arguments
+        """
+        return self.runner_class(
             playbook=args.playbook,
             host_list=os.path.realpath(args.inventory),
             module_path=args.module_path,
@@ -235,7 +471,7 @@ class PlaybookScript(GenericAnsibleScript):
             only_tags=None,
             skip_tags=None,
             subset=None,
-            inventory=None,
+            inventory=self.get_inventory(args),
             check=False,
             diff=False,
             any_errors_fatal=False,
@@ -243,8 +479,17 @@ class PlaybookScript(GenericAnsibleScript):
             force_handlers=False,
             show_colors=args.colors,
             show_facts=args.show_facts,
+            result_loader=self.get_result_loader(args),
+            result_writers=self.result_writers,
+            retain_results=self.retain_results,
+            facts_cache=self.get_facts_cache(args),
+            spill_threshold=args.spill_threshold,
+            spill_directory=args.spill_directory,
         )
 
+    def run(self, args):
+        runner = self.get_runner(args)
+
         try:
             return runner.run()
         except AnsibleError, emsg:
@@ -0,0 +1,175 @@
+"""
+JSON encoder backends for result output
+
+All to_json methods encode data with the default encoder, which is the first
+available backend in JSON_ENCODER_BACKENDS unless selected explicitly with
+set_default_encoder().
+"""
+
+from ansiblereporter import RunnerError
+
+# Types returned by sorted_value without further checks
+SCALAR_TYPES = frozenset(( str, unicode, int, long, float, bool, type(None), ))
+
+JSON_ENCODER_BACKENDS = ( 'ujson', 'simplejson', 'json', )
+
+
+class EncodedDict(dict):
+    """Dictionary encoded with sorted keys
+
+    The json and simplejson encoders iterate dictionary subclasses with their
+    own methods, so keys of an EncodedDict are encoded in sorted order without
+    sort_keys, which would disable the json module C encoder.
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(sorted(dict.keys(self)))
+
+    def items(self):
+        return sorted(dict.items(self))
+
+    def iteritems(self):
+        return iter(sorted(dict.items(self)))
+
+
+def sorted_value(value):
+    """Return value for encoding with sorted keys
+
+    Returns a copy of value with dictionaries as EncodedDict, sequences as lists
+    and objects with as_dict() method as their data. Other values are returned
+    as they are.
+    """
+    if type(value) in SCALAR_TYPES:
+        return value
+    if isinstance(value, dict):
+        return EncodedDict([(key, sorted_value(item)) for key, item in dict.iteritems(value)])
+    if isinstance(value, (list, tuple)):
+        return [sorted_value(item) for item in value]
+    if hasattr(value, 'as_dict'):
+        return sorted_value(value.as_dict())
+    return value
+
+
+def encode_object(value):
+    """Encode object to json
+
+    Default callback for encoders to encode objects which are not dictionaries,
+    like CompactResult, with their as_dict() method.
+    """
+    if hasattr(value, 'as_dict'):
+        return value.as_dict()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+class JSONEncoder(object):
+    """Standard library json encoder
+
+    Keys are sorted by all encoders in both modes. The standard library json
+    module does not use its C encoder when sort_keys is set, so compact output
+    is encoded without sort_keys from a copy made with sorted_value(), which
+    the C encoder iterates in sorted key order. Indented output is always
+    encoded with the python encoder and sorted with sort_keys.
+    """
+    name = 'json'
+    c_sort_keys = False
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        try:
+            self.module = __import__(self.name)
+        except ImportError:
+            raise RunnerError('JSON encoder module not available: %s' % self.name)
+
+    def dumps(self, value, indent=2):
+        """Return value as json
+
+        Indent is ignored for compact encoders.
+        """
+        if self.compact or not indent:
+            if not self.c_sort_keys:
+                return self.module.dumps(sorted_value(value), separators=(',', ':'), default=encode_object)
+            return self.module.dumps(value, separators=(',', ':'), sort_keys=True, default=encode_object)
+        return self.module.dumps(value, indent=indent, sort_keys=True, default=encode_object)
+
+
+class SimpleJSONEncoder(JSONEncoder):
+    """simplejson encoder
+
+    Same as JSONEncoder, using simplejson C speedups when installed. The
+    simplejson C encoder sorts keys itself, so compact output is encoded with
+    sort_keys.
+    """
+    name = 'simplejson'
+    c_sort_keys = True
+
+
+class UJSONEncoder(JSONEncoder):
+    """ujson encoder
+
+    ujson encodes also indented output in C, iterating dictionaries directly
+    and sorting keys in C. Objects which are not dictionaries are encoded with
+    their toDict() method.
+    """
+    name = 'ujson'
+
+    def dumps(self, value, indent=2):
+        if self.compact or not indent:
+            return self.module.dumps(value, sort_keys=True)
+        return self.module.dumps(value, indent=indent, sort_keys=True)
+
+
+ENCODERS = {
+    'json': JSONEncoder,
+    'simplejson': SimpleJSONEncoder,
+    'ujson': UJSONEncoder,
+}
+
+__default_encoder__ = None
+
+
+def get_encoder(name=None, compact=False):
+    """Return JSON encoder
+
+    Return encoder for given backend name, or the first available backend in
+    JSON_ENCODER_BACKENDS if name is None.
+
+    Raises RunnerError if given backend is unknown or not installed.
+    """
+    if name is not None:
+        if name not in ENCODERS:
+            raise RunnerError('Unknown JSON encoder: %s' % name)
+        return ENCODERS[name](compact=compact)
+
+    for name in JSON_ENCODER_BACKENDS:
+        try:
+            return ENCODERS[name](compact=compact)
+        except RunnerError:
+            continue
+
+    raise RunnerError('No JSON encoder available')
+
+
+def set_default_encoder(name=None, compact=False):
+    """Set default encoder
+
+    Set encoder used by dumps(). See get_encoder for arguments.
+    """
+    global __default_encoder__
+    __default_encoder__ = get_encoder(name, compact)
+    return __default_encoder__
+
+
+def default_encoder():
+    """Return default encoder
+
+    Default encoder is detected on first call if it was not set
+    """
+    if __default_encoder__ is None:
+        return set_default_encoder()
+    return __default_encoder__
+
+
+def dumps(value, indent=2):
+    """Return value as json with the default encoder"""
+    return default_encoder().dumps(value, indent=indent)
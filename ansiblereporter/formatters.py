@@ -0,0 +1,201 @@
+"""
+Result formatters for reporter scripts
+
+Format results as text for ansible-reporter and ansible-playbook-reporter
+output, or as json.
+
+RunnerResultFormatter and PlaybookResultFormatter produce the same output as
+runner_result_formatter and playbook_result_formatter, with output templates
+and color escape codes compiled once when the formatter is created.
+"""
+
+import os
+
+from termcolor import colored, COLORS, RESET
+
+# Result statuses formatted with output instead of error message
+OUTPUT_STATUSES = ( 'ok', 'error', 'unknown', )
+
+DEFAULT_FORMAT_BATCH_SIZE = 1000
+
+
+def runner_result_formatter(result):
+    """Format ansible command result
+
+    Format result as mostly ansible compatible text with colors
+    """
+    output = ''
+
+    if result.status in OUTPUT_STATUSES:
+        status = '%s | %s | rc=%d >>' % (result.host, result.ansible_status, result.returncode)
+        if result.returncode == 0:
+            color = 'green'
+        else:
+            color = 'red'
+        output += colored(status, color)
+        output += colored('\n%s' % result.stdout, color)
+
+    else:
+        status = '%s | %s => %s' % (result.host, result.ansible_status, result.error)
+        output += colored(status, 'red')
+        if result.stdout or result.stderr:
+            output += colored('\n%s\n%s' % (result.stdout, result.stderr), 'red')
+
+    return output
+
+
+def playbook_result_formatter(result):
+    """Format playbook task result
+
+    Format result with host, status, return code and command, with output or
+    ansible facts, with colors
+    """
+    output = ''
+
+    if result.status in OUTPUT_STATUSES:
+        status = '%s | %s | %s | %s' % (result.host, result.ansible_status, result.returncode, result.command)
+        if result.returncode == 0:
+            color = 'green'
+        else:
+            color = 'red'
+
+        output += colored('%s' % status, color)
+        if result.stdout:
+            output += colored('\n%s' % result.stdout, color)
+
+    elif result.status == 'facts':
+        output += colored('%s | %s | %s | %s' % (result.host, result.ansible_status, result.returncode, result.command), 'cyan')
+        for key, value in result.ansible_facts.items():
+            output += colored('\n  %s %s' % (key, value), 'cyan')
+
+    else:
+        status = '%s | %s | %s | %s' % (result.host, result.ansible_status, result.error, result.command)
+        output += colored(status, 'red')
+        if result.stdout or result.stderr:
+            output += colored('\n%s\n%s' % (result.stdout, result.stderr), 'red')
+
+    return output
+
+
+def result_formatter_json(result):
+    """Format result as json"""
+    return result.to_json()
+
+
+class ResultFormatter(object):
+    """Compiled result formatter
+
+    Formatter with templates compiled in compile(). Colors are disabled if
+    colors is not set or ANSI_COLORS_DISABLED environment variable is set,
+    like with termcolor.
+
+    Formatters are called with a result and return formatted text. By default
+    results are formatted like runner_result_formatter. Child classes override
+    compile() and __call__() for other output.
+    """
+
+    def __init__(self, colors=True):
+        self.colors = colors and os.getenv('ANSI_COLORS_DISABLED') is None
+        self.compile()
+
+    def template(self, color, *parts):
+        """Return template
+
+        Each part is colored separately with color, like with termcolor.colored
+        """
+        if not self.colors:
+            return ''.join(parts)
+        start = '\033[%dm' % COLORS[color]
+        return ''.join('%s%s%s' % (start, part, RESET) for part in parts)
+
+    def compile(self):
+        """Compile templates
+
+        Compile templates for ansible command result output
+        """
+        self.ok = self.template('green', '%s | %s | rc=%d >>', '\n%s')
+        self.error = self.template('red', '%s | %s | rc=%d >>', '\n%s')
+        self.failed = self.template('red', '%s | %s => %s')
+        self.failed_output = self.template('red', '%s | %s => %s', '\n%s\n%s')
+
+    def __call__(self, result):
+        if result.status in OUTPUT_STATUSES:
+            returncode = result.returncode
+            template = returncode == 0 and self.ok or self.error
+            return template % (result.host, result.ansible_status, returncode, result.stdout)
+
+        stdout = result.stdout
+        stderr = result.stderr
+        if stdout or stderr:
+            return self.failed_output % (result.host, result.ansible_status, result.error, stdout, stderr)
+        return self.failed % (result.host, result.ansible_status, result.error)
+
+
+class RunnerResultFormatter(ResultFormatter):
+    """Compiled ansible command result formatter
+
+    Same output as runner_result_formatter, which is the default output of
+    ResultFormatter
+    """
+
+
+class PlaybookResultFormatter(ResultFormatter):
+    """Compiled playbook task result formatter
+
+    Same output as playbook_result_formatter
+    """
+
+    def compile(self):
+        self.ok = self.template('green', '%s | %s | %s | %s')
+        self.ok_output = self.template('green', '%s | %s | %s | %s', '\n%s')
+        self.error = self.template('red', '%s | %s | %s | %s')
+        self.error_output = self.template('red', '%s | %s | %s | %s', '\n%s')
+        self.facts = self.template('cyan', '%s | %s | %s | %s')
+        self.fact = self.template('cyan', '\n  %s %s')
+        self.failed = self.template('red', '%s | %s | %s | %s')
+        self.failed_output = self.template('red', '%s | %s | %s | %s', '\n%s\n%s')
+
+    def __call__(self, result):
+        status = result.status
+
+        if status in OUTPUT_STATUSES:
+            returncode = result.returncode
+            stdout = result.stdout
+            if returncode == 0:
+                template = stdout and self.ok_output or self.ok
+            else:
+                template = stdout and self.error_output or self.error
+            values = (result.host, result.ansible_status, returncode, result.command)
+            if stdout:
+                values += (stdout, )
+            return template % values
+
+        if status == 'facts':
+            fact = self.fact
+            return self.facts % (result.host, result.ansible_status, result.returncode, result.command) + \
+                ''.join(fact % (key, value) for key, value in result.ansible_facts.items())
+
+        stdout = result.stdout
+        stderr = result.stderr
+        values = (result.host, result.ansible_status, result.error, result.command)
+        if stdout or stderr:
+            return self.failed_output % (values + (stdout, stderr))
+        return self.failed % values
+
+
+def write_formatted(fd, results, formatter, batch_size=DEFAULT_FORMAT_BATCH_SIZE):
+    """Write formatted results
+
+    Results are formatted with formatter, each followed by a newline, and
+    written to file object fd in batches of batch_size results.
+    """
+    batch = []
+    for result in results:
+        batch.append(formatter(result))
+        if len(batch) >= batch_size:
+            batch.append('')
+            fd.write('\n'.join(batch))
+            batch = []
+    if batch:
+        batch.append('')
+        fd.write('\n'.join(batch))
@@ -4,10 +4,19 @@ Extended ansible.inventory.Inventory to support editing and saving to file.
 
 import os
 import re
+import stat
+import time
+import bisect
+import cPickle
+import fnmatch
+import hashlib
 import configobj
 
 from systematic.log import Logger
 
+from ansible import __version__ as ansible_version
+from ansible import utils
+from ansible.constants import DEFAULT_HOST_LIST
 from ansible.errors import AnsibleError
 from ansible.inventory import Inventory as AnsibleInventory
 from ansible.inventory.group import Group
@@ -15,6 +24,36 @@ from ansible.inventory.host import Host
 
 HEADER = """# Automatically generated with ansible-inventory tool."""
 
+DEFAULT_INVENTORY_CACHE_TTL = 300
+
+# Inventory attributes not stored to inventory cache
+INVENTORY_CACHE_SKIP_ATTRIBUTES = (
+    'log',
+    'cache',
+    '_vars_plugins',
+    '__host_names__',
+    '_vault_password',
+)
+
+# Characters starting a wildcard in host pattern terms
+HOST_PATTERN_WILDCARD = re.compile(r'[*?]')
+
+# Host names ansible adds as implicit localhost when not in inventory
+IMPLICIT_LOCALHOST_NAMES = (
+    'localhost',
+    '127.0.0.1',
+    '::1',
+)
+
+
+# Buffer size for writing saved inventory files
+INVENTORY_SAVE_BUFFER_SIZE = 1024 * 1024
+
+# Host name with a number, split to prefix, number and suffix
+HOST_RANGE_NAME = re.compile(r'^(.*\D)(\d+)(\D*)$')
+
+# Minimum number of consecutive hosts saved as a host range
+HOST_RANGE_MIN_HOSTS = 3
 
 HOST_VARIABLES_SAVE_IGNORE = (
     'group_names',
@@ -27,14 +66,519 @@ class InventoryError(Exception):
     pass
 
 
+def compact_host_ranges(entries):
+    """Compact host names to host ranges
+
+    Entries is a list of (name, variables) tuples, where variables is the
+    formatted host variables string. At least HOST_RANGE_MIN_HOSTS hosts with
+    consecutive numbers of same width, same prefix and suffix and same variables
+    are compacted to an ansible host range entry like web[0001:4000].
+
+    Returns list of (name, variables) tuples sorted by name
+    """
+    compacted = []
+    numbered = []
+    for name, variables in entries:
+        match = ':' not in name and '[' not in name and HOST_RANGE_NAME.match(name) or None
+        if match is None:
+            compacted.append(( name, variables ))
+            continue
+        prefix, number, suffix = match.groups()
+        numbered.append(( prefix, suffix, len(number), variables, int(number), name ))
+    numbered.sort()
+
+    def add_range(run):
+        if len(run) < HOST_RANGE_MIN_HOSTS:
+            compacted.extend(( entry[5], entry[3] ) for entry in run)
+        else:
+            prefix, suffix, width, variables = run[0][:4]
+            compacted.append((
+                '%s[%0*d:%0*d]%s' % (prefix, width, run[0][4], width, run[-1][4], suffix),
+                variables
+            ))
+
+    run = []
+    for entry in numbered:
+        if run and (entry[:4] != run[-1][:4] or entry[4] != run[-1][4] + 1):
+            add_range(run)
+            run = []
+        run.append(entry)
+    add_range(run)
+
+    compacted.sort()
+    return compacted
+
+
+def compact_host_names(names):
+    """Compact host names to host ranges
+
+    Returns sorted list of host names, with consecutive numbered names
+    compacted to host ranges like web[0001:4000] (see compact_host_ranges).
+    """
+    return [name for name, variables in compact_host_ranges([(name, '') for name in names])]
+
+
+class InventoryCache(object):
+    """Compiled inventory cache
+
+    Store parsed inventory state (groups, hosts, variables, parser and host
+    pattern index) to a pickle file in directory, one file per inventory path.
+
+    Cached inventory is valid while modification times and sizes, or content
+    hashes, of inventory files and group_vars and host_vars files match. Cache
+    of dynamic inventories (executable scripts) is also invalidated after ttl
+    seconds.
+
+    Cache read and write errors are logged and the cache is bypassed.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_INVENTORY_CACHE_TTL):
+        self.log = Logger().default_stream
+        self.directory = os.path.expanduser(os.path.expandvars(directory))
+        self.ttl = ttl
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, (ecode, emsg):
+                raise InventoryError('Error creating inventory cache directory %s: %s' % (self.directory, emsg))
+
+    def __path__(self, host_list):
+        digest = hashlib.sha1(os.path.realpath(host_list)).hexdigest()
+        return os.path.join(self.directory, '%s.inventory' % digest)
+
+    def __source_files__(self, host_list):
+        """Return inventory source files
+
+        Returns sorted list of inventory files and group_vars and host_vars
+        files for host_list, or None if host_list is not a file or directory.
+        """
+        if os.path.isdir(host_list):
+            basedir = host_list
+            paths = [os.path.join(host_list, name) for name in os.listdir(host_list)]
+            paths = [path for path in paths if os.path.isfile(path)]
+        elif os.path.isfile(host_list):
+            basedir = os.path.dirname(host_list)
+            paths = [host_list]
+        else:
+            return None
+
+        for name in ( 'group_vars', 'host_vars', ):
+            for root, dirs, files in os.walk(os.path.join(basedir, name)):
+                paths.extend(os.path.join(root, filename) for filename in files)
+
+        return sorted(os.path.realpath(path) for path in paths)
+
+    def __file_hash__(self, path):
+        try:
+            return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+        except IOError:
+            return None
+
+    def is_dynamic(self, host_list):
+        """Check if inventory is dynamic (executable script or directory with scripts)"""
+        if os.path.isdir(host_list):
+            paths = [os.path.join(host_list, name) for name in os.listdir(host_list)]
+        else:
+            paths = [host_list]
+        return any(os.path.isfile(path) and os.access(path, os.X_OK) for path in paths)
+
+    def signature(self, host_list, hashes=False):
+        """Return inventory source signature
+
+        Returns list of (path, mtime, size) tuples for inventory source files,
+        or (path, hash) tuples if hashes is set. Returns None if inventory
+        source is not files.
+        """
+        paths = self.__source_files__(host_list)
+        if paths is None:
+            return None
+
+        signature = []
+        for path in paths:
+            if hashes:
+                signature.append(( path, self.__file_hash__(path) ))
+            else:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    return None
+                signature.append(( path, st.st_mtime, st.st_size ))
+        return signature
+
+    def state(self, inventory):
+        """Return inventory state to cache
+
+        Returns dictionary of inventory attributes, including ansible Inventory
+        attributes in __slots__, which are not in the instance __dict__.
+        """
+        state = {}
+        for key in getattr(AnsibleInventory, '__slots__', ()):
+            if hasattr(inventory, key):
+                state[key] = getattr(inventory, key)
+        state.update(inventory.__dict__)
+        for key in INVENTORY_CACHE_SKIP_ATTRIBUTES:
+            state.pop(key, None)
+        return state
+
+    def load(self, inventory, host_list, vault_password=None):
+        """Load inventory from cache
+
+        Load cached state to inventory object. Vault password is not cached
+        and is set from vault_password. Returns True if a valid cached
+        inventory was loaded, False otherwise.
+        """
+        if not isinstance(host_list, basestring):
+            return False
+
+        path = self.__path__(host_list)
+        try:
+            entry = cPickle.load(open(path, 'rb'))
+        except IOError:
+            return False
+        except Exception, emsg:
+            self.log.debug('invalid inventory cache entry %s: %s' % (path, emsg))
+            return False
+
+        if entry.get('version', None) != ansible_version:
+            return False
+
+        if entry.get('signature', None) != self.signature(host_list):
+            if entry.get('hashes', None) != self.signature(host_list, hashes=True):
+                return False
+            self.log.debug('inventory source modified without changes: %s' % host_list)
+
+        if entry.get('dynamic', False) and time.time() - entry.get('time', 0) > self.ttl:
+            return False
+
+        for key, value in entry['state'].items():
+            setattr(inventory, key, value)
+        inventory._vault_password = vault_password
+        utils.plugins.vars_loader.add_directory(inventory.basedir(), with_subdir=True)
+        inventory._vars_plugins = [plugin for plugin in utils.plugins.vars_loader.all(inventory)]
+        self.log.debug('loaded inventory %s from cache' % host_list)
+        return True
+
+    def save(self, inventory, host_list):
+        """Store inventory to cache
+
+        Inventory state is written to a temporary file which is renamed to the
+        cache entry path.
+        """
+        if not isinstance(host_list, basestring):
+            return
+
+        signature = self.signature(host_list)
+        if signature is None:
+            return
+
+        # Build the host pattern index to store it with the inventory
+        inventory.pattern_index
+
+        path = self.__path__(host_list)
+        tmpfile = '%s.%d.tmp' % (path, os.getpid())
+        entry = {
+            'version': ansible_version,
+            'time': time.time(),
+            'dynamic': self.is_dynamic(host_list),
+            'signature': signature,
+            'hashes': self.signature(host_list, hashes=True),
+            'state': self.state(inventory),
+        }
+
+        try:
+            fd = open(tmpfile, 'wb')
+            cPickle.dump(entry, fd, cPickle.HIGHEST_PROTOCOL)
+            fd.close()
+            os.rename(tmpfile, path)
+
+        except (IOError, OSError), (ecode, emsg):
+            self.log.debug('error writing inventory cache entry %s: %s' % (path, emsg))
+        except (TypeError, cPickle.PicklingError), emsg:
+            self.log.debug('error caching inventory %s: %s' % (host_list, emsg))
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+
+
+class HostPatternIndex(object):
+    """Host pattern index
+
+    Index of inventory hosts and groups for resolving host patterns with set
+    operations instead of scanning all groups and hosts for each pattern.
+
+    Hosts are numbered in inventory order, and each group maps to the host ids
+    of the group in group order. Host and group names are kept sorted, so names
+    matching wildcard terms are looked up by the literal prefix of the term
+    with binary search. Resolved terms are cached.
+
+    Hosts are returned in the same order as ansible returns them: hosts of
+    each term in term order, and hosts of a term in the order ansible finds
+    them when going through the inventory groups.
+
+    The index is not updated when inventory is modified.
+    """
+
+    def __init__(self, inventory):
+        self.hosts = []
+        self.host_ids = {}
+        self.groups = {}
+        self.group_index = {}
+        self.terms = {}
+        self.term_sets = {}
+
+        # Position (group index, index in group) where each host is first found
+        self.first_keys = []
+
+        for group_index, group in enumerate(inventory.get_groups()):
+            ids = []
+            for position, host in enumerate(group.get_hosts()):
+                if host.name not in self.host_ids:
+                    self.host_ids[host.name] = len(self.hosts)
+                    self.hosts.append(host)
+                    self.first_keys.append(( group_index, position, ))
+                ids.append(self.host_ids[host.name])
+            self.groups[group.name] = tuple(ids)
+            self.group_index[group.name] = group_index
+
+        self.all = tuple(range(len(self.hosts)))
+        self.host_names = sorted(self.host_ids)
+        self.group_names = sorted(self.groups)
+
+    def __matching_names__(self, names, term):
+        """Return names in sorted names list matching wildcard or regex term"""
+        if term.startswith('~'):
+            try:
+                regex = re.compile(term[1:])
+            except re.error, emsg:
+                raise InventoryError('Invalid host pattern %s: %s' % (term, emsg))
+            return [name for name in names if regex.search(name)]
+
+        prefix = term[:HOST_PATTERN_WILDCARD.search(term).start()]
+        regex = re.compile(fnmatch.translate(term))
+        matches = []
+        for name in names[bisect.bisect_left(names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            if regex.match(name):
+                matches.append(name)
+        return matches
+
+    def __ordered__(self, groups, hosts):
+        """Return ids of hosts in groups and hosts in ansible order
+
+        Ansible goes through the inventory groups in order, adding all hosts of
+        matching groups and matching hosts of other groups, so each host is
+        ordered by the first group position where it is found.
+        """
+        if len(groups) == 1 and not hosts:
+            return self.groups[groups[0]]
+
+        keys = {}
+        for name in groups:
+            group_index = self.group_index[name]
+            for position, host in enumerate(self.groups[name]):
+                key = ( group_index, position, )
+                if host not in keys or key < keys[host]:
+                    keys[host] = key
+        for host in hosts:
+            key = self.first_keys[host]
+            if host not in keys or key < keys[host]:
+                keys[host] = key
+        return tuple(sorted(keys, key=keys.__getitem__))
+
+    def term(self, term):
+        """Resolve a pattern term
+
+        Returns tuple of ids of hosts matching term by host or group name in
+        ansible order, or None if term can't be resolved with the index (range
+        subscripts and implicit localhost).
+        """
+        if term in self.terms:
+            return self.terms[term]
+
+        if term == 'all':
+            ids = self.all
+
+        elif term.startswith('~') or HOST_PATTERN_WILDCARD.search(term):
+            if '[' in term and not term.startswith('~'):
+                return None
+            ids = self.__ordered__(
+                self.__matching_names__(self.group_names, term),
+                [self.host_ids[name] for name in self.__matching_names__(self.host_names, term)],
+            )
+
+        elif '[' in term:
+            return None
+
+        else:
+            ids = self.__ordered__(
+                term in self.groups and [term] or [],
+                term in self.host_ids and [self.host_ids[term]] or [],
+            )
+            if not ids and term in IMPLICIT_LOCALHOST_NAMES:
+                return None
+
+        self.terms[term] = ids
+        return ids
+
+    def term_set(self, term):
+        """Resolve a pattern term to frozenset of host ids
+
+        Returns None if term can't be resolved with the index.
+        """
+        if term not in self.term_sets:
+            ids = self.term(term)
+            if ids is None:
+                return None
+            self.term_sets[term] = frozenset(ids)
+        return self.term_sets[term]
+
+    def resolve(self, terms):
+        """Resolve list of pattern terms
+
+        Terms are combined like ansible does: hosts of regular terms in term
+        order without duplicates (all hosts if there are none), where a term
+        naming a host only matches the host and not a group with the same
+        name, limited to
+        hosts in terms starting with & and excluding hosts in terms starting
+        with !. Empty terms are ignored.
+
+        Returns list of host ids, or None if some term can't be resolved with
+        the index.
+        """
+        regular = []
+        intersect = []
+        exclude = []
+        for term in terms:
+            if term.startswith('!'):
+                exclude.append(term[1:])
+            elif term.startswith('&'):
+                intersect.append(term[1:])
+            elif term:
+                regular.append(term)
+
+        ids = []
+        seen = set()
+        for term in regular or ['all']:
+            # Like ansible, a regular term naming a host only matches the host
+            if term in self.host_ids:
+                matches = ( self.host_ids[term], )
+            else:
+                matches = self.term(term)
+            if matches is None:
+                return None
+            if not ids:
+                ids = list(matches)
+                seen.update(matches)
+                continue
+            for host in matches:
+                if host not in seen:
+                    seen.add(host)
+                    ids.append(host)
+
+        for term in intersect:
+            matches = self.term_set(term)
+            if matches is None:
+                return None
+            ids = [host for host in ids if host in matches]
+
+        for term in exclude:
+            matches = self.term_set(term)
+            if matches is None:
+                return None
+            ids = [host for host in ids if host not in matches]
+
+        return ids
+
+
 class Inventory(AnsibleInventory):
+    """Ansible inventory
+
+    Extends ansible inventory with editing and saving. If cache_directory is
+    given, parsed inventory is stored to and loaded from an InventoryCache in
+    the directory.
+
+    Host patterns are resolved with a HostPatternIndex built on first lookup.
+    """
+
     def __init__(self, *args, **kwargs):
         self.log = Logger().default_stream
+        self.__pattern_index__ = None
+        self.__host_names__ = None
+
+        cache_directory = kwargs.pop('cache_directory', None)
+        cache_ttl = kwargs.pop('cache_ttl', DEFAULT_INVENTORY_CACHE_TTL)
+        self.cache = cache_directory is not None and InventoryCache(cache_directory, cache_ttl) or None
+
+        host_list = args and args[0] or kwargs.get('host_list', DEFAULT_HOST_LIST)
+        vault_password = len(args) > 1 and args[1] or kwargs.get('vault_password', None)
+        if self.cache is not None and self.cache.load(self, host_list, vault_password):
+            return
+
         try:
             AnsibleInventory.__init__(self, *args, **kwargs)
         except AnsibleError, emsg:
             raise InventoryError(emsg)
 
+        if self.cache is not None:
+            self.cache.save(self, host_list)
+
+    @property
+    def pattern_index(self):
+        """Host pattern index, built on first access"""
+        if self.__pattern_index__ is None:
+            self.__pattern_index__ = HostPatternIndex(self)
+        return self.__pattern_index__
+
+    def clear_pattern_index(self):
+        """Clear host pattern index after inventory is modified"""
+        self.__pattern_index__ = None
+
+    def clear_pattern_cache(self):
+        """Clear ansible pattern cache and the host pattern index
+
+        Called by ansible add_host and group_by action plugins after they have
+        modified inventory groups directly.
+        """
+        AnsibleInventory.clear_pattern_cache(self)
+        self.clear_pattern_index()
+
+    def get_hosts(self, pattern='all'):
+        """Return hosts matching pattern
+
+        Hosts are returned in the same order as ansible returns them, limited
+        by subset and restriction like in ansible. Patterns which can't be
+        resolved with the pattern index are looked up by ansible.
+        """
+        if isinstance(pattern, list):
+            terms = pattern
+        else:
+            terms = pattern.replace(';', ':').split(':')
+
+        index = self.pattern_index
+        ids = index.resolve(terms)
+        if ids is None:
+            return AnsibleInventory.get_hosts(self, pattern)
+
+        subset = getattr(self, '_subset', None)
+        if subset:
+            subset_ids = index.resolve(subset)
+            if subset_ids is None:
+                return AnsibleInventory.get_hosts(self, pattern)
+            subset_ids = set(subset_ids)
+            ids = [i for i in ids if i in subset_ids]
+
+        hosts = [index.hosts[i] for i in ids]
+        for attr in ( '_restriction', '_also_restriction', ):
+            restriction = getattr(self, attr, None)
+            if restriction is not None:
+                restriction = set(restriction)
+                hosts = [host for host in hosts if host.name in restriction]
+
+        return hosts
+
     def add_group(self, group):
         if isinstance(group, basestring):
             group = Group(group)
@@ -43,54 +587,157 @@ class Inventory(AnsibleInventory):
             AnsibleInventory.add_group(self, group)
         except AnsibleError, emsg:
             raise InventoryError(emsg)
+        self.__modified__()
         return group
 
+    def __modified__(self, groups=()):
+        """Clear cached host lists of modified groups and the host pattern index"""
+        for group in groups:
+            if hasattr(group, 'clear_hosts_cache'):
+                group.clear_hosts_cache()
+        self.clear_pattern_index()
+
+    @property
+    def host_names(self):
+        """Dictionary of inventory hosts by name, built on first access"""
+        if self.__host_names__ is None:
+            self.__host_names__ = dict((h.name, h) for g in self.get_groups() for h in g.hosts)
+        return self.__host_names__
+
     def add_host(self, group, host):
+        """Add host to group
+
+        Raises InventoryError if host is already in group
+        """
+        group, duplicates = self.add_hosts(group, [host])
+        if duplicates:
+            raise InventoryError('Host already in group %s: %s' % (group.name, duplicates[0]))
+        return group
+
+    def add_hosts(self, group, hosts):
+        """Add hosts to group
+
+        Group and hosts may be names or ansible Group and Host objects. Group is
+        added to inventory if it does not exist. Host names already in inventory
+        are added as the existing hosts, looked up from host_names. Hosts
+        already in group are skipped.
+
+        Returns tuple of group and list of names of hosts already in group
+        """
         if isinstance(group, basestring):
             g = self.get_group(group)
             group = g is None and self.add_group(group) or g
 
-        if host in [h.name for h in group.get_hosts()]:
-            raise InventoryError('Host already in group %s: %s' % (group.name, host))
+        existing = self.host_names
+        members = set(h.name for h in group.get_hosts())
+        duplicates = []
 
-        if isinstance(host, basestring):
-            host = Host(host)
+        for host in hosts:
+            name = isinstance(host, basestring) and host or host.name
+            if name in members:
+                duplicates.append(name)
+                continue
 
-        self.log.debug('group %s: add host: %s' % (group.name, host.name))
-        group.add_host(host)
-        return group
+            if isinstance(host, basestring):
+                host = existing.get(name, None) or Host(name)
+            existing.setdefault(name, host)
+
+            self.log.debug('group %s: add host: %s' % (group.name, name))
+            group.add_host(host)
+            members.add(name)
+
+        self.__modified__([group])
+        return group, duplicates
+
+    def remove_hosts(self, group, names):
+        """Remove hosts from group
+
+        Returns list of names of hosts not found in group
+        """
+        if isinstance(group, basestring):
+            g = self.get_group(group)
+            if g is None:
+                raise InventoryError('Group not found: %s' % group)
+            group = g
+
+        remove = set(names)
+        removed = [host for host in group.hosts if host.name in remove]
+        group.hosts[:] = [host for host in group.hosts if host.name not in remove]
+        for host in removed:
+            self.log.debug('group %s: remove host: %s' % (group.name, host.name))
+            if group in host.groups:
+                host.groups.remove(group)
+
+        self.__modified__([group])
+        found = set(host.name for host in removed)
+        return [name for name in names if name not in found]
+
+    def remove_groups(self, names):
+        """Remove groups from inventory
+
+        Groups are also removed from child groups of remaining groups.
+
+        Returns list of names of groups not found in inventory
+        """
+        remove = set(names)
+        removed = [group for group in self.groups if group.name in remove]
+        self.groups[:] = [group for group in self.groups if group.name not in remove]
+
+        modified = []
+        for group in self.groups:
+            if any(child.name in remove for child in group.child_groups):
+                group.child_groups[:] = [child for child in group.child_groups if child.name not in remove]
+                modified.append(group)
+
+        for group in removed:
+            self.log.debug('remove inventory group: %s' % group.name)
+            for host in group.hosts:
+                if group in host.groups:
+                    host.groups.remove(group)
+
+        self.__modified__(modified)
+        found = set(group.name for group in removed)
+        return [name for name in names if name not in found]
 
     def save(self, path, minimize=True):
-        def parse_hosts(hosts, minimize):
-            if not minimize:
-                return hosts
+        """Save inventory to INI file
 
-            prefixed = {}
-            grouped = []
+        Inventory is written to a temporary file which is renamed to path. If
+        minimize is set, hosts with consecutive numbers and same variables are
+        saved as host ranges.
 
-            return hosts
+        Raises InventoryError if the file can't be written.
+        """
+        host_variables = {}
 
-        def format_host(host):
-            line = host.name
-            for k, v in host.get_variables().items():
-                if k not in HOST_VARIABLES_SAVE_IGNORE:
-                    line += ' %s=%s' % (k,v)
-            return line
+        def format_variables(host):
+            if host.name not in host_variables:
+                variables = host.get_variables()
+                host_variables[host.name] = ''.join(
+                    ' %s=%s' % (k, variables[k]) for k in sorted(variables)
+                    if k not in HOST_VARIABLES_SAVE_IGNORE
+                )
+            return host_variables[host.name]
+
+        def format_hosts(hosts):
+            entries = [(host.name, format_variables(host)) for host in hosts]
+            if minimize:
+                entries = compact_host_ranges(entries)
+            return ''.join('%s%s\n' % entry for entry in entries)
 
         path = os.path.expanduser(os.path.expandvars(path))
+        tmpfile = '%s.%d.tmp' % (path, os.getpid())
         self.log.debug('Saving inventory to %s' % path)
 
         try:
-
-            fd = open(path, 'wb')
+            fd = open(tmpfile, 'wb', INVENTORY_SAVE_BUFFER_SIZE)
 
             fd.write(HEADER)
 
-            ungrouped = parse_hosts(self.get_group('ungrouped').hosts, minimize)
-            if ungrouped:
+            ungrouped = self.get_group('ungrouped')
+            if ungrouped is not None and ungrouped.hosts:
                 fd.write('\n')
-                for host in ungrouped:
-                    fd.write('%s\n' % format_host(host))
+                fd.write(format_hosts(ungrouped.hosts))
 
             for group in sorted(self.get_groups(), lambda a, b: cmp(a.name, b.name)):
                 if group.name in ('all', 'ungrouped'):
@@ -103,15 +750,18 @@ class Inventory(AnsibleInventory):
 
                 else:
                     fd.write('\n[%s]\n' % (group.name))
-                    for host in parse_hosts(group.hosts, minimize):
-                        fd.write('%s\n' % format_host(host))
+                    fd.write(format_hosts(group.hosts))
 
             fd.write('\n')
             fd.close()
 
-        except IOError:
-            raise InventoryError('Error opening %s for writing: %s' % (path, emsg))
-
-        except OSError, (ecode, emsg):
-            raise InventoryError('Error opening %s for writing: %s' % (path, emsg))
+            if os.path.isfile(path):
+                os.chmod(tmpfile, stat.S_IMODE(os.stat(path).st_mode))
+            os.rename(tmpfile, path)
 
+        except (IOError, OSError), (ecode, emsg):
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+            raise InventoryError('Error writing inventory %s: %s' % (path, emsg))
@@ -63,11 +63,14 @@ class PlaybookCallbacks(callbacks.PlaybookCallbacks):
 
     Please note that callback on_vars_prompt is NOT overridden, so if your
     code asks for variables we will use the standard chatty query version!
+
+    If stats is given, stats.task_start(name) is called when a task starts.
     """
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, stats=None):
         callbacks.PlaybookCallbacks.__init__(self, verbose)
         self.log = Logger().default_stream
+        self.stats = stats
 
     def on_start(self):
         self.log.debug('starting playbook')
@@ -80,6 +83,8 @@ class PlaybookCallbacks(callbacks.PlaybookCallbacks):
 
     def on_task_start(self, name, is_conditional):
         self.log.debug('playbook starting task "%s"' % name)
+        if self.stats is not None:
+            self.stats.task_start(name)
 
     def on_setup(self):
         self.log.debug('playbook setup')
@@ -3,19 +3,142 @@ Ansible runner wrapper for output reporting tasks
 """
 
 import os
+import sys
 import json
+import errno
+import resource
+import heapq
+import itertools
+import operator
+import select
+import signal
+import cPickle
+import subprocess
+import collections
+import multiprocessing
+import bisect
+import time
+import Queue
+import zlib
+import tempfile
+import threading
 
 from datetime import datetime
+from ansible import utils
+from ansible.inventory import Inventory
 from ansible.playbook import PlayBook
 from ansible.runner import Runner
 from seine.address import IPv4Address
 from systematic.log import Logger
 
 from ansiblereporter import SortedDict, RunnerError
+from ansiblereporter import encoder
+from ansiblereporter.analytics import OutputTable
+from ansiblereporter.archive import ResultArchive, DEFAULT_ARCHIVE_BATCH_SIZE
+from ansiblereporter.cache import variables_hash
+from ansiblereporter.formatters import write_formatted
+from ansiblereporter.inventory import compact_host_names
+from ansiblereporter.store import ResultStore, DEFAULT_SPILL_THRESHOLD
+from ansiblereporter.transport import SSHTransport, argv_command, sudo_command
 from ansiblereporter.reporter_callbacks import AggregateStats, PlaybookCallbacks, PlaybookRunnerCallbacks
 
 
 RESULT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+DEFAULT_WRITER_THREADS = 8
+DEFAULT_CONSOLE_BUFFER_SIZE = 65536
+DEFAULT_ASYNC_CONCURRENCY = 1000
+DEFAULT_SHARDS = multiprocessing.cpu_count()
+
+# Poll interval in milliseconds and pipe read size for AsyncRunner
+POLL_INTERVAL = 1000
+PIPE_READ_SIZE = 65536
+
+# Open files used by each AsyncRunner command in flight, and open files
+# reserved for everything else in the process
+ASYNC_COMMAND_FILES = 2
+ASYNC_RESERVED_FILES = 64
+
+
+def file_limit_concurrency():
+    """Return number of AsyncRunner commands allowed by open files limit
+
+    Returns None if the number of open files is not limited.
+    """
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, resource.error):
+        return None
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(1, (soft - ASYNC_RESERVED_FILES) / ASYNC_COMMAND_FILES)
+
+
+def result_sort_key(host):
+    """Return sort key for results of host
+
+    Results are sorted by host address, if host is an IPv4 address, and host
+    name, like Result.compare_fields within a result set.
+    """
+    try:
+        address = IPv4Address(host)
+    except ValueError:
+        address = None
+    return ( address, host, )
+
+
+class ResultHost(object):
+    """Host of results
+
+    Host name and sort key shared by all results of a host in a result list.
+    Host name is interned and the host address is only parsed when the sort
+    key or address is first needed.
+    """
+    __slots__ = ( 'name', '__sort_key__', )
+
+    def __init__(self, name):
+        if isinstance(name, str):
+            name = intern(name)
+        self.name = name
+        self.__sort_key__ = None
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def sort_key(self):
+        """Return sort key of host, see result_sort_key"""
+        if self.__sort_key__ is None:
+            self.__sort_key__ = result_sort_key(self.name)
+        return self.__sort_key__
+
+    @property
+    def address(self):
+        """Return host address as IPv4Address, or None if host is not an address"""
+        return self.sort_key[0]
+
+
+class HostTable(dict):
+    """Table of result hosts
+
+    Dictionary of host names to ResultHost objects. Unknown hosts are added
+    when looked up.
+    """
+
+    def __missing__(self, name):
+        host = self[name] = ResultHost(name)
+        return host
+
+
+def result_host(resultset, host):
+    """Return ResultHost for host
+
+    Returns host from host table of the result list of resultset, or a new
+    ResultHost if resultset is not part of a result list with host table.
+    """
+    table = getattr(getattr(resultset, 'resultset', None), 'host_table', None)
+    if table is None:
+        return ResultHost(host)
+    return table[host]
 
 
 class Result(SortedDict):
@@ -28,15 +151,11 @@ class Result(SortedDict):
     def __init__(self, resultset, host, data):
         SortedDict.__init__(self)
         self.resultset = resultset
-        self.host = host
+        self.__host__ = result_host(resultset, host)
+        self.host = self.__host__.name
 
         self.__cached_properties__ = {}
 
-        try:
-            self.address = IPv4Address(host)
-        except ValueError:
-            self.address = None
-
         self.update(**data)
 
     def __repr__(self):
@@ -97,6 +216,16 @@ class Result(SortedDict):
         """
         return 'unknown'
 
+    @property
+    def address(self):
+        """Return host address as IPv4Address, or None if host is not an address"""
+        return self.__host__.address
+
+    @property
+    def sort_key(self):
+        """Return sort key of result host"""
+        return self.__host__.sort_key
+
     @property
     def show_colors(self):
         """Should be show colors
@@ -175,7 +304,8 @@ class Result(SortedDict):
     def ansible_facts(self):
         """Return facts for host
 
-        If ansible facts were collected, return the dictionary.
+        If ansible facts were collected, return the dictionary. Serialized
+        facts are decoded on each call.
 
         Otherwise return None.
         """
@@ -393,260 +523,1691 @@ class Result(SortedDict):
 
         Return dictionary as json data. No custom properties are added by default.
         """
-        return json.dumps(self, indent=indent)
+        return encoder.dumps(self, indent=indent)
 
 
-class ResultSet(list):
-    """Set of ansible results
+class CompactResult(object):
+    """Compact ansible result
 
-    ResultSet is group of ansible results (contacted, dark). ResultSets
-    are created by ResultList parsing.
+    Alternative to Result for very large runs, to be used as result_loader.
 
-    Each result is loaded with class attribute result_loader which defaults
-    to Result.
+    Commonly used fields are stored as typed attributes in __slots__ and rest
+    of the result is stored as compact json string, which is only decoded when
+    other keys are accessed. Ansible facts are stored as SerializedFacts. The
+    most recently decoded payload is cached, so looking up several keys of the
+    same result decodes the payload once. Provides same properties as Result
+    and read only dictionary access to result data.
     """
+    __slots__ = (
+        'resultset', 'host', '__host__',
+        '__rc__', '__changed__', '__failed__', '__start__', '__end__',
+        '__stdout__', '__stderr__', '__msg__', '__module_name__', '__module_args__',
+        '__status__', '__facts__', '__payload__',
+    )
+    compare_fields = ( 'resultset', 'address', 'host', )
 
-    def __init__(self, resultset, name):
-        self.log = Logger().default_stream
+    # Result and data of the most recently decoded payload
+    __decoded_payload__ = ( None, None, )
+
+    # Result keys stored as typed attributes
+    typed_keys = {
+        'rc': '__rc__',
+        'changed': '__changed__',
+        'failed': '__failed__',
+        'stdout': '__stdout__',
+        'stderr': '__stderr__',
+        'msg': '__msg__',
+        'ansible_facts': '__facts__',
+    }
+
+    def __init__(self, resultset, host, data):
         self.resultset = resultset
-        self.name = name
-        self.ansible_facts = {}
+        self.__host__ = result_host(resultset, host)
+        self.host = self.__host__.name
 
-    @property
-    def result_loader(self):
-        return self.resultset.runner.result_loader
+        payload = {}
+        for key, value in data.items():
+            if key in self.typed_keys or key in ( 'start', 'end', ):
+                continue
+            payload[key] = value
 
-    def append(self, host, result):
-        """Append a result
+        for key, attr in self.typed_keys.items():
+            setattr(self, attr, data.get(key, None))
+        if self.__facts__ is not None and not isinstance(self.__facts__, SerializedFacts):
+            self.__facts__ = SerializedFacts.serialize(self.__facts__)
 
-        Results are appended with self.result_loader, which must be subclass of
-        Result class.
+        self.__start__ = self.__parse_datetime__('start', data.get('start', None))
+        self.__end__ = self.__parse_datetime__('end', data.get('end', None))
 
-        If the result contains ansible facts (key ansible_facts), parent result list's
-        cached copy of ansible facts is overwritten.
-        """
-        list.append(self, self.result_loader(self, host, result))
+        invocation = data.get('invocation', {})
+        self.__module_name__ = invocation.get('module_name', '')
+        self.__module_args__ = invocation.get('module_args', '')
 
-        if 'ansible_facts' in result:
-            self.ansible_facts[host] = result['ansible_facts']
+        try:
+            self.__payload__ = json.dumps(payload, separators=(',', ':'))
+        except TypeError:
+            self.__payload__ = payload
 
-    def to_json(self, indent=2):
-        """"Return as json
+        self.__status__ = self.__parse_status__(data)
 
-        Returns list of results formatted as json
+    def __repr__(self):
+        if self.end is not None:
+            return ' '.join([self.host, self.status, self.end.strftime('%Y-%m-%d %H:%M:%S')])
+        else:
+            return ' '.join([self.host, self.status])
 
-        """
-        return json.dumps(self, indent=indent)
+    def __cmp__(self, other):
+        """Compare with self.compare_fields"""
+        for key in self.compare_fields:
+            a = getattr(self, key)
+            b = getattr(other, key)
+            if a != b:
+                return cmp(a, b)
+        return 0
 
+    def __parse_datetime__(self, key, value):
+        """Parse datetime value
 
-class ResultList(object):
-    """List of results
+        Parse value as datetime using RESULT_DATE_FORMAT format. Returns None
+        if value is None.
 
-    Parent class for collected results, with two result sets in self.results:
+        Raises RunnerError if value could not be parsed.
+        """
+        if value is None:
+            return None
 
-    self.results['contacted'] = result set of contacted hosts
-    self.results['dark'] = result set of unreachable hosts
+        try:
+            return datetime.strptime(value, RESULT_DATE_FORMAT)
+        except ValueError:
+            raise RunnerError('Error parsing %s date value %s' % (key, value))
 
-    Note: a host may be in both sets if it was unreachable in middle of a playbook
-    """
+    def __parse_status__(self, data):
+        """Parse result status
 
-    def __init__(self, runner, show_colors=False):
-        self.log = Logger().default_stream
-        self.runner = runner
-        self.show_colors = show_colors
+        Parse status from result data when result is loaded. Returns None if
+        status must be parsed with __parse_custom_status_codes__.
+        """
+        if 'failed' in data:
+            return 'failed'
 
-        self.results = {
-            'contacted': self.resultset_loader(self, 'contacted'),
-            'dark': self.resultset_loader(self, 'dark'),
-        }
+        elif 'rc' in data:
+            if data.get('rc', 0) == 0:
+                return 'ok'
+            else:
+                return 'error'
 
+        elif self.module_name == 'ping':
+            return data.get('ping', None) == 'pong' and 'ok' or 'failed'
 
-    @property
-    def resultset_loader(self):
-        return self.runner.resultset_loader
+        elif self.module_name == 'setup':
+            if data.get('ansible_facts', None):
+                return 'facts'
+            else:
+                return 'pending_facts'
 
-    def sort(self):
-        """Sort results
+        return None
 
-        Sorts the ResultSets contacted and dark
+    def __parse_custom_status_codes__(self):
+        """Parse custom status
 
-        """
-        self.results['dark'].sort()
-        self.results['contacted'].sort()
+        Override this function to parse status code from custom modules.
 
-    def to_json(self, indent=2):
-        """Return as json
+        By default this always returns 'unknown'
+        """
+        return 'unknown'
 
-        Returns all results formatted to json
+    def __payload_data__(self):
+        """Return decoded payload
 
+        Return payload dictionary, decoded only if payload of this result was
+        not the most recently decoded payload. The returned dictionary is
+        shared and must not be modified.
         """
-        return json.dumps({
-                'contacted': self.results['contacted'],
-                'dark': self.results['dark'],
-            },
-            indent=indent
-        )
+        if isinstance(self.__payload__, dict):
+            return self.__payload__
+        result, data = CompactResult.__decoded_payload__
+        if result is not self:
+            data = json.loads(self.__payload__)
+            CompactResult.__decoded_payload__ = ( self, data, )
+        return data
 
-    def write_to_file(self, filename, formatter=None, json=False):
-        """Write results to file
+    @property
+    def address(self):
+        """Return host address as IPv4Address, or None if host is not an address"""
+        return self.__host__.address
 
-        Arguments
-          filename: target filename to write
-          formatter: callback to format the file entry in text files
-          json: if set, formatter is ignored and self.to_json is used to write file
+    @property
+    def sort_key(self):
+        """Return sort key of result host"""
+        return self.__host__.sort_key
 
-        Either formatter callback or json=True is required
+    def as_dict(self):
+        """Return result data
 
-        Raises RunnerError if file writing failed.
+        Return result data as SortedDict, including the keys stored as typed
+        attributes.
         """
+        data = SortedDict(self.__payload_data__())
+        for key, attr in self.typed_keys.items():
+            value = getattr(self, attr)
+            if value is not None:
+                data[key] = value
+        if self.__start__ is not None:
+            data['start'] = self.__start__.strftime(RESULT_DATE_FORMAT)
+        if self.__end__ is not None:
+            data['end'] = self.__end__.strftime(RESULT_DATE_FORMAT)
+        return data
 
-        if not formatter and not json:
-            raise RunnerError('Either formatter callback or json flag must be set')
-
+    def __date_value__(self, key):
+        """Return start or end date formatted with RESULT_DATE_FORMAT"""
+        if key == 'start':
+            value = self.__start__
+        else:
+            value = self.__end__
+        if value is None:
+            raise KeyError(key)
+        return value.strftime(RESULT_DATE_FORMAT)
+
+    def __contains__(self, key):
+        if key in self.typed_keys:
+            return getattr(self, self.typed_keys[key]) is not None
+        if key == 'start':
+            return self.__start__ is not None
+        if key == 'end':
+            return self.__end__ is not None
+        return key in self.__payload_data__()
+
+    def __getitem__(self, key):
+        if key in self.typed_keys:
+            value = getattr(self, self.typed_keys[key])
+            if value is None:
+                raise KeyError(key)
+            return value
+        if key in ( 'start', 'end', ):
+            return self.__date_value__(key)
+        return self.__payload_data__()[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def get(self, key, default=None):
         try:
-            fd = open(filename, 'w')
-            if json:
-                fd.write('%s\n' % self.to_json())
-            elif formatter:
-                for result in self.results['contacted']:
-                    fd.write('%s\n' % formatter(result))
-                for result in self.results['dark']:
-                    fd.write('%s\n' % formatter(result))
+            return self[key]
+        except KeyError:
+            return default
 
-            fd.close()
+    def keys(self):
+        """Return keys as sorted list"""
+        return self.as_dict().keys()
 
-        except IOError, (ecode, emsg):
-            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
-        except OSError, (ecode, emsg):
-            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+    def items(self):
+        """Return items sorted by self.keys()"""
+        return self.as_dict().items()
 
+    def values(self):
+        """Return values sorted by self.keys()"""
+        return self.as_dict().values()
 
-class RunnerResults(ResultList):
-    """Runner results
+    @property
+    def show_colors(self):
+        """Should be show colors
 
-    Collect results from ansible runner output
+        Accessor to runner's show_colors flag. Used for result processing
+        in callbacks
+        """
+        return self.resultset.runner.show_colors
 
-    """
+    @property
+    def changed(self):
+        """Return changed boolean flag"""
+        return self.__changed__ and True or False
 
-    def __init__(self, runner, results, show_colors=False):
-        ResultList.__init__(self, runner, show_colors)
+    @property
+    def returncode(self):
+        """Return code
 
-        for k in ( 'dark', 'contacted', ):
-            if k in results:
-                group = self.results[k]
-                for host, result in results[k].items():
-                    group.append(host, result)
+        Return 'rc' as integer in range 0-255. If value is not integer or not
+        in range, return 255.
 
+        If 'rc' was not in result, return 0
+        """
+        try:
+            rc = int(self.__rc__ or 0)
+            if rc < 0 or rc > 255:
+                raise ValueError
+            return rc
+        except ValueError:
+            return 255
 
-class PlaybookResults(ResultList, AggregateStats):
-    """Playbook results
+    @property
+    def error(self):
+        """Return error message or 'UNKNOWN ERROR'"""
+        if self.__msg__ is None:
+            return 'UNKNOWN ERROR'
+        return self.__msg__
 
-    Collect results from playbook runs, grouped by host
+    @property
+    def stdout(self):
+        """Return stdout or ''"""
+        return self.__stdout__ or ''
 
-    """
+    @property
+    def stderr(self):
+        """Return stderr or ''"""
+        return self.__stderr__ or ''
 
-    def __init__(self, runner, show_colors=False):
-        AggregateStats.__init__(self)
-        ResultList.__init__(self, runner, show_colors)
+    @property
+    def state(self):
+        """Return result state
+
+        Returns host state i.e. resultset name ('contacted', 'dark')
+        """
+        return self.resultset.name
 
     @property
-    def grouped_by_host(self):
-        """Return task output grouped by host
+    def ansible_facts(self):
+        """Return facts for host
 
-        Collect task output from different hosts in contacted and dark groups
-        and return as dictionary, where each result is grouped under the host.
+        If ansible facts were collected, return the dictionary. Serialized
+        facts are decoded on each call.
 
+        Otherwise return None.
         """
-        data = { 'contacted': [], 'dark': [] }
-        res = {}
-        for result in self.results['contacted']:
-            if result.host not in res:
-                res[result.host] = {'host': result.host, 'results': []}
+        return self.resultset.ansible_facts.get(self.host, None)
 
-            if result.module_name == 'setup' and not self.runner.show_facts:
-                continue
+    @property
+    def start(self):
+        """Return start as datetime or None"""
+        return self.__start__
 
-            res[result.host]['results'].append(result.copy())
+    @property
+    def end(self):
+        """Return end as datetime or None"""
+        return self.__end__
 
+    @property
+    def delta(self):
+        """Return end - start timedelta value or None"""
+        if self.__start__ is None or self.__end__ is None:
+            return None
+        return self.__end__ - self.__start__
 
-        for key in sorted(res.keys()):
-            data['contacted'].append(res[key])
+    @property
+    def module_name(self):
+        """Module name or empty string"""
+        return self.__module_name__
 
-        res = {}
-        for result in self.results['dark']:
-            if result.host not in res:
-                res[result.host] = {'host': result.host, 'results': []}
+    @property
+    def module_args(self):
+        """Module args or empty string"""
+        return self.__module_args__
 
-            if result.module_name == 'setup' and not self.runner.show_facts:
-                continue
+    @property
+    def command(self):
+        """Return executed command
 
-            res[result.host]['results'].append(result.copy())
+        For shell and command modules return module_args, for any other module
+        return module name.
+        """
+        if self.__module_name__ in ( 'command', 'shell' ):
+            return self.__module_args__
+        return self.__module_name__
 
-        for key in sorted(res.keys()):
-            data['dark'].append(res[key])
+    @property
+    def status(self):
+        """Return result status
 
-        return data
+        Status is parsed when result is loaded, see Result.status for values.
+        """
+        if self.__status__ is None:
+            return self.__parse_custom_status_codes__()
+        return self.__status__
 
-    def compute(self, runner_results, setup=False, poll=False, ignore_errors=False):
-        """Import results
+    @property
+    def ansible_status(self):
+        """Return ansible style status string
 
-        Override for default ansible playbook callback to import task results
-        to main process. You can't directly write from tasks without callback to
-        main process because they are running in separate processes launched by
-        multiprocess module.
+        Return status string as shown by ansible command output:
+        success: command was successful
+        FAILED: command failed
         """
-        for (host, value) in runner_results.get('contacted', {}).iteritems():
-            self.results['contacted'].append(host, value)
+        if self.status == 'ok':
+            return 'success'
 
-        for (host, value) in runner_results.get('dark', {}).iteritems():
-            self.results['dark'].append(host, value)
+        elif self.status in ( 'failed', 'error', ):
+            return 'FAILED'
 
-    def summarize(self, host):
-        """Return summary
+        return self.status
 
-        Return summary for a host.
+    def copy(self):
+        """Return a copy
 
-        TODO - fix this function to actually return what is expected. Right now
-        it does not and exists only to override ansible playbook default APIs
+        Copy shares the immutable attribute values with this result
         """
-        return { 'contacted': self.results['contacted'], 'dark': self.results['dark'], }
+        value = self.__class__.__new__(self.__class__)
+        for attr in self.__slots__:
+            setattr(value, attr, getattr(self, attr))
+        return value
 
-    def to_json(self, indent=2):
-        """Return as json
+    def write_to_directory(self, directory, formatter, extension):
+        """Write file to directory with formatter callback
 
-        Returns data in json format using self.grouped_by_host for ordering.
-        """
-        return json.dumps(self.grouped_by_host, indent=indent)
+        See Result.write_to_directory
 
-    def write_to_file(self, filename, formatter=None, json=False):
-        """Write results to file
+        Raises RunnerError if file writing failed.
+        """
+        filename = os.path.join(directory, '%s.%s' % (self.host, extension))
+        self.resultset.log.debug('writing to %s' % filename)
+
+        try:
+            open(filename, 'w').write('%s\n' % formatter(self))
+
+        except IOError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+        except OSError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+
+    def format(self, callback):
+        """Format data
+
+        Format this result with callback function. Used for writing files
+        """
+        return callback(self)
+
+    def toDict(self):
+        """Return result data for ujson encoder"""
+        return self.as_dict()
+
+    def to_json(self, indent=2):
+        """Return as json
+
+        Return result data as json data.
+        """
+        return encoder.dumps(self.as_dict(), indent=indent)
+
+
+class DeduplicatedResult(object):
+    """Result with identical output from many hosts
+
+    Groups results with identical output, with the first result of the group
+    in self.result and names of all hosts in self.hosts, each host once in
+    order of first result. Other attributes are read from the first result,
+    except host which returns the compacted host list joined with commas, so
+    the group can be formatted with the result formatters.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.hosts = [result.host]
+        self.__host_names__ = set(self.hosts)
+
+    def add_host(self, host):
+        """Add host to the group, unless it is already in the group"""
+        if host not in self.__host_names__:
+            self.__host_names__.add(host)
+            self.hosts.append(host)
+
+    def __repr__(self):
+        return '%d hosts %s' % (len(self.hosts), self.result)
+
+    def __getattr__(self, attr):
+        return getattr(self.result, attr)
+
+    @property
+    def host(self):
+        return ','.join(compact_host_names(self.hosts))
+
+    def as_dict(self):
+        """Return result data with host list"""
+        data = {
+            'hosts': compact_host_names(self.hosts),
+            'count': len(self.hosts),
+            'state': self.result.state,
+            'status': self.result.status,
+            'command': self.result.command,
+            'rc': self.result.returncode,
+            'stdout': self.result.stdout,
+            'stderr': self.result.stderr,
+        }
+        if self.result.status not in ( 'ok', 'error', 'unknown', ):
+            data['msg'] = self.result.error
+        return data
+
+    def format(self, callback):
+        """Format data
+
+        Format this result group with callback function.
+        """
+        return callback(self)
+
+    def toDict(self):
+        """Return result data for ujson encoder"""
+        return self.as_dict()
+
+    def to_json(self, indent=2):
+        """Return as json"""
+        return encoder.dumps(self.as_dict(), indent=indent)
+
+
+class NDJSONWriter(object):
+    """Newline delimited json writer
+
+    Write results to a file as they arrive, one json object per line with
+    host, state, status and task metadata and the result data in 'result'.
+
+    File is flushed when flush_interval seconds have passed since previous
+    flush, so the file can be followed while results are collected.
+    """
+
+    def __init__(self, output, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+        self.close_file = isinstance(output, basestring)
+        if self.close_file:
+            self.filename = output
+            try:
+                self.fd = open(output, 'w')
+            except IOError, (ecode, emsg):
+                raise RunnerError('Error writing file %s: %s' % (output, emsg))
+            except OSError, (ecode, emsg):
+                raise RunnerError('Error writing file %s: %s' % (output, emsg))
+        else:
+            self.filename = getattr(output, 'name', None)
+            self.fd = output
+
+    def format(self, result, task=None):
+        """Format result
+
+        Return result as single line of json
+        """
+        return encoder.dumps({
+                'host': result.host,
+                'state': result.state,
+                'status': result.status,
+                'task': task,
+                'module_name': result.module_name,
+                'command': result.command,
+                'result': result,
+            },
+            indent=None
+        )
+
+    def write(self, result, task=None):
+        """Write result
+
+        Write result as json line, flushing the file if flush_interval has
+        passed since previous flush.
+
+        Raises RunnerError if file writing failed.
+        """
+        try:
+            self.fd.write('%s\n' % self.format(result, task))
+            if time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+        except IOError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (self.filename, emsg))
+
+    def flush(self):
+        self.fd.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        """Close writer
+
+        Flushes output and closes the file if it was opened by the writer
+        """
+        self.flush()
+        if self.close_file:
+            self.fd.close()
+
+
+class ConsoleWriter(object):
+    """Buffered console writer
+
+    Write formatted results of contacted hosts to stdout and other results to
+    stderr, buffering output to writes of about buffer_size bytes. Buffer of
+    the other stream is flushed when output switches between stdout and
+    stderr, so the order of output is preserved on a terminal.
+
+    If the reader of output exits (broken pipe), rest of the output is
+    discarded and self.broken_pipe is set.
+    """
+
+    def __init__(self, formatter=None, stdout=None, stderr=None, buffer_size=DEFAULT_CONSOLE_BUFFER_SIZE):
+        self.formatter = formatter
+        self.buffer_size = buffer_size
+        self.broken_pipe = False
+        self.streams = {
+            'stdout': stdout is not None and stdout or sys.stdout,
+            'stderr': stderr is not None and stderr or sys.stderr,
+        }
+        self.__buffers__ = { 'stdout': [], 'stderr': [] }
+        self.__sizes__ = { 'stdout': 0, 'stderr': 0 }
+        self.__current__ = None
+
+    def __write__(self, name, text):
+        if self.broken_pipe:
+            return
+
+        if self.__current__ != name:
+            if self.__current__ is not None:
+                self.flush(self.__current__)
+            self.__current__ = name
+
+        self.__buffers__[name].append(text)
+        self.__sizes__[name] += len(text)
+        if self.__sizes__[name] >= self.buffer_size:
+            self.flush(name)
+
+    def __broken_pipe__(self):
+        """Discard further output after broken pipe
+
+        Standard output and error are redirected to /dev/null, so flushing
+        them when the process exits does not fail again.
+        """
+        self.broken_pipe = True
+        for name in ( 'stdout', 'stderr', ):
+            self.__buffers__[name] = []
+            self.__sizes__[name] = 0
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        for stream in ( sys.stdout, sys.stderr, ):
+            try:
+                os.dup2(devnull, stream.fileno())
+            except (AttributeError, OSError, ValueError):
+                pass
+        os.close(devnull)
+
+    def message(self, text):
+        """Write text line to stdout"""
+        self.__write__('stdout', '%s\n' % text)
+
+    def error(self, text):
+        """Write text line to stderr"""
+        self.__write__('stderr', '%s\n' % text)
+
+    def write(self, result, task=None):
+        """Write result
+
+        Write result formatted with self.formatter, followed by an empty line,
+        to stdout for contacted hosts and to stderr for other hosts.
+        """
+        text = '%s\n\n' % self.formatter(result)
+        if result.state == 'contacted':
+            self.__write__('stdout', text)
+        else:
+            self.__write__('stderr', text)
+
+    def flush(self, name=None):
+        """Write buffered output
+
+        Writes buffered output of stream name, or both streams if name is None.
+
+        Raises RunnerError if writing failed for other reason than broken pipe.
+        """
+        for name in name is not None and ( name, ) or ( 'stdout', 'stderr', ):
+            if self.broken_pipe or not self.__buffers__[name]:
+                continue
+
+            text = ''.join(self.__buffers__[name])
+            self.__buffers__[name] = []
+            self.__sizes__[name] = 0
+            try:
+                self.streams[name].write(text)
+                self.streams[name].flush()
+            except IOError, (ecode, emsg):
+                if ecode == errno.EPIPE:
+                    self.__broken_pipe__()
+                    return
+                raise RunnerError('Error writing output to %s: %s' % (name, emsg))
+
+    def close(self):
+        """Write all buffered output"""
+        self.flush()
+
+
+class DirectoryWriter(object):
+    """Threaded directory writer
+
+    Write host output files to a directory with a bounded pool of writer
+    threads. Each file is written to a temporary file in the directory and
+    renamed to directory/<host>.<extension> when complete.
+
+    Errors from writer threads are raised as RunnerError from close().
+    """
+
+    def __init__(self, directory, extension, threads=DEFAULT_WRITER_THREADS):
+        self.log = Logger().default_stream
+        self.directory = directory
+        self.extension = extension
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self.started = time.time()
+
+        # Files are created with mkstemp as 0600, set mode from umask like open()
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0666 & ~umask
+
+        self.__lock__ = threading.Lock()
+        self.__queue__ = Queue.Queue(maxsize=threads * 4)
+        self.__threads__ = []
+        for i in range(max(1, threads)):
+            thread = threading.Thread(target=self.__worker__)
+            thread.daemon = True
+            thread.start()
+            self.__threads__.append(thread)
+
+    def __worker__(self):
+        while True:
+            entry = self.__queue__.get()
+            try:
+                if entry is None:
+                    return
+                self.__write_file__(*entry)
+            except Exception, e:
+                # Keep the worker running, close() would block on a full queue
+                with self.__lock__:
+                    self.errors.append('Error writing file for %s: %s' % (entry[0], e))
+            finally:
+                self.__queue__.task_done()
+
+    def __write_file__(self, host, text):
+        filename = os.path.join(self.directory, '%s.%s' % (host, self.extension))
+        self.log.debug('writing to %s' % filename)
+
+        if not isinstance(text, basestring):
+            text = unicode(text)
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        text += '\n'
+
+        tmpfile = None
+        try:
+            fd, tmpfile = tempfile.mkstemp(prefix='.%s.' % host, dir=self.directory)
+            try:
+                offset = 0
+                while offset < len(text):
+                    offset += os.write(fd, text[offset:])
+            finally:
+                os.close(fd)
+            os.chmod(tmpfile, self.mode)
+            os.rename(tmpfile, filename)
+
+        except (IOError, OSError), (ecode, emsg):
+            if tmpfile is not None and os.path.exists(tmpfile):
+                try:
+                    os.unlink(tmpfile)
+                except OSError:
+                    pass
+            with self.__lock__:
+                self.errors.append('Error writing file %s: %s' % (filename, emsg))
+            return
+
+        with self.__lock__:
+            self.files += 1
+            self.bytes += len(text)
+
+    def write(self, host, text):
+        """Write host file
+
+        Queue text to be written to file for host. Unicode text is written as
+        utf-8. Blocks if the queue is full.
+        """
+        self.__queue__.put((host, text))
+
+    def close(self):
+        """Wait for writes to finish
+
+        Waits for queued files to be written and stops writer threads. Logs
+        write throughput.
+
+        Raises RunnerError if any file could not be written.
+        """
+        for thread in self.__threads__:
+            self.__queue__.put(None)
+        for thread in self.__threads__:
+            thread.join()
+
+        elapsed = time.time() - self.started
+        self.log.info('wrote %d files (%d bytes) to %s in %.2f seconds: %.1f files/s, %.1f KB/s' % (
+            self.files, self.bytes, self.directory, elapsed,
+            elapsed and self.files / elapsed or 0,
+            elapsed and self.bytes / elapsed / 1024 or 0,
+        ))
+
+        if self.errors:
+            raise RunnerError(self.errors[0])
+
+
+class SerializedFacts(object):
+    """Serialized ansible facts
+
+    Ansible facts stored as compressed compact json, decoded only when the
+    facts are requested. Facts trees are large and mostly never looked at
+    unless facts are shown, so keeping them serialized saves most of the
+    memory used by setup results.
+
+    Serialized facts are encoded to json output with as_dict() and toDict().
+    """
+    __slots__ = ( 'data', )
+
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return '<serialized facts, %d bytes>' % len(self.data)
+
+    def __nonzero__(self):
+        return True
+
+    @classmethod
+    def serialize(cls, facts):
+        """Serialize facts
+
+        Returns SerializedFacts for facts, or facts unmodified if facts can't
+        be encoded to json.
+        """
+        try:
+            return cls(zlib.compress(json.dumps(facts, separators=(',', ':')), 1))
+        except (TypeError, ValueError):
+            return facts
+
+    def decode(self):
+        """Return facts dictionary"""
+        return json.loads(zlib.decompress(self.data))
+
+    def as_dict(self):
+        return self.decode()
+
+    def toDict(self):
+        return self.decode()
+
+
+class HostFacts(dict):
+    """Ansible facts by host
+
+    Dictionary of ansible facts by host name, reading through to a persistent
+    facts cache (FactsCache) if one is given. Cached facts are loaded lazily,
+    when facts for a host are first looked up. Facts set to the dictionary are
+    gathered facts and stored to the cache. Facts set by other modules than
+    setup are added with merge(), and are not stored to the cache.
+
+    If serialize is set, facts are stored as SerializedFacts and decoded each
+    time they are looked up.
+    """
+
+    def __init__(self, cache=None, serialize=False):
+        dict.__init__(self)
+        self.cache = cache
+        self.serialize = serialize
+        self.__gathered__ = set()
+
+    def __load__(self, host):
+        if dict.__contains__(self, host):
+            return True
+        if self.cache is None:
+            return False
+        facts = self.cache.get(host)
+        if facts is None:
+            return False
+        dict.__setitem__(self, host, facts)
+        self.__gathered__.add(host)
+        return True
+
+    def __decode__(self, host):
+        facts = dict.__getitem__(self, host)
+        if isinstance(facts, SerializedFacts):
+            return facts.decode()
+        return facts
+
+    def __contains__(self, host):
+        return self.__load__(host)
+
+    def __getitem__(self, host):
+        if not self.__load__(host):
+            raise KeyError(host)
+        return self.__decode__(host)
+
+    def __setitem__(self, host, facts):
+        if self.cache is not None and not isinstance(facts, SerializedFacts):
+            self.cache.set(host, facts)
+        if self.serialize and not isinstance(facts, SerializedFacts):
+            facts = SerializedFacts.serialize(facts)
+        dict.__setitem__(self, host, facts)
+        self.__gathered__.add(host)
+
+    def get(self, host, default=None):
+        if not self.__load__(host):
+            return default
+        return self.__decode__(host)
+
+    def merge(self, host, facts):
+        """Merge facts to facts of host
+
+        Facts from modules like set_fact and include_vars are added to the
+        existing facts of host, without storing them to the cache, so they
+        don't replace gathered facts in the cache.
+        """
+        merged = dict(self.get(host, None) or {})
+        merged.update(facts)
+        if self.serialize:
+            merged = SerializedFacts.serialize(merged)
+        dict.__setitem__(self, host, merged)
+
+    def gathered(self, host):
+        """Return facts gathered with setup or loaded from cache
+
+        Returns None if facts of host were not gathered.
+        """
+        if not self.__load__(host) or host not in self.__gathered__:
+            return None
+        return self.__decode__(host)
+
+    def stored(self, host):
+        """Return facts for host as stored, without decoding"""
+        return dict.get(self, host, None)
+
+
+class ResultSet(list):
+    """Set of ansible results
+
+    ResultSet is group of ansible results (contacted, dark). ResultSets
+    are created by ResultList parsing.
+
+    Each result is loaded with class attribute result_loader which defaults
+    to Result.
+    """
+    stored_records = False
+    retains_results = True
+
+    def __init__(self, resultset, name):
+        self.log = Logger().default_stream
+        self.resultset = resultset
+        self.name = name
+        self.ansible_facts = HostFacts(
+            getattr(resultset.runner, 'facts_cache', None),
+            serialize=not getattr(resultset.runner, 'show_facts', True),
+        )
+
+    @property
+    def result_loader(self):
+        return self.resultset.runner.result_loader
+
+    def __update_facts__(self, host, result):
+        """Update facts from result
+
+        Store ansible facts from setup result to self.ansible_facts, or merge
+        facts from results of other modules to them. Returns result, or a copy
+        of setup result with serialized facts if facts are serialized.
+        """
+        if 'ansible_facts' in result:
+            if result.get('invocation', {}).get('module_name', None) != 'setup':
+                self.ansible_facts.merge(host, result['ansible_facts'])
+                return result
+
+            self.ansible_facts[host] = result['ansible_facts']
+            if self.ansible_facts.serialize:
+                result = dict(result)
+                result['ansible_facts'] = self.ansible_facts.stored(host)
+        return result
+
+    def append(self, host, result):
+        """Append a result
+
+        Results are appended with self.result_loader, which must be subclass of
+        Result class.
+
+        If the result contains ansible facts (key ansible_facts), parent result list's
+        cached copy of ansible facts is overwritten, and facts are stored to
+        runner's facts cache if it is set. If runner's show_facts is not set,
+        facts are stored serialized, also in the result.
+
+        Appended result is passed to result writers of parent result list.
+
+        Returns the appended result.
+        """
+        result = self.__update_facts__(host, result)
+        value = self.result_loader(self, host, result)
+        list.append(self, value)
+
+        if self.resultset.writers:
+            self.resultset.write_result(value)
+
+        return value
+
+    def append_record(self, host, result):
+        """Append a result
+
+        Append result with self.append. Returns tuple (result, record), where
+        record refers to the result with self.load_record. For ResultSet the
+        record is the result itself.
+        """
+        value = self.append(host, result)
+        return value, value
+
+    def load_record(self, record):
+        """Return result for record returned by self.append_record"""
+        return record
+
+    def sort(self, *args, **kwargs):
+        """Sort results
+
+        Without arguments results are sorted by sort keys of result hosts,
+        which is the same order as with default compare_fields within one
+        result set, without comparing results with each other. Results with
+        custom compare_fields or given sort arguments are sorted with
+        list.sort.
+        """
+        if not args and not kwargs and self.result_loader.compare_fields == Result.compare_fields:
+            kwargs['key'] = operator.attrgetter('sort_key')
+        list.sort(self, *args, **kwargs)
+
+    def output_table(self, separator=None, fields=None, maxsplit=-1, statuses=None):
+        """Return output table
+
+        Returns OutputTable with output lines of results split to fields. See
+        ansiblereporter.analytics.OutputTable for arguments.
+        """
+        return OutputTable(self, separator=separator, fields=fields, maxsplit=maxsplit, statuses=statuses)
+
+    def to_json(self, indent=2):
+        """"Return as json
+
+        Returns list of results formatted as json. Results are iterated to a
+        list, because C encoders read list items directly and would not see
+        results of a SpillResultSet.
+
+        """
+        return encoder.dumps(list(self), indent=indent)
+
+
+class StreamResultSet(ResultSet):
+    """Set of ansible results passed only to result writers
+
+    Results are loaded and written to result writers of the parent result
+    list as they are appended, but not kept in the set, so memory use does not
+    grow with the number of results. Used when results are only consumed by
+    streaming writers like NDJSONWriter. Facts are still stored to
+    self.ansible_facts.
+    """
+    retains_results = False
+
+    def append(self, host, result):
+        """Write a result
+
+        Result is loaded with self.result_loader and passed to result writers
+        of parent result list. Returns the result.
+        """
+        result = self.__update_facts__(host, result)
+        value = self.result_loader(self, host, result)
+
+        if self.resultset.writers:
+            self.resultset.write_result(value)
+
+        return value
+
+
+class SpillResultSet(ResultSet):
+    """Set of ansible results spilled to disk
+
+    Results are kept in memory until there are more than spill_threshold
+    results (runner attribute, defaults to DEFAULT_SPILL_THRESHOLD). Then all
+    results are moved to a ResultStore file in runner's spill_directory, and
+    only file offsets and sort keys are kept in memory.
+
+    Results are loaded from the store when iterated or looked up, so results
+    returned are new objects for each lookup. Records returned by append_record
+    are sequence numbers of the results.
+    """
+    stored_records = True
+
+    def __init__(self, resultset, name):
+        ResultSet.__init__(self, resultset, name)
+        self.threshold = getattr(resultset.runner, 'spill_threshold', None) or DEFAULT_SPILL_THRESHOLD
+        self.directory = getattr(resultset.runner, 'spill_directory', None)
+        self.store = None
+
+        # Results or store offsets by sequence number, iteration order and sort keys of records
+        self.__records__ = []
+        self.__order__ = None
+        self.__hosts__ = []
+
+    def __sort_key__(self, host):
+        return result_host(self, host).sort_key
+
+    def __spill__(self):
+        """Move results in memory to the store"""
+        self.log.debug('spilling %d %s results to disk' % (len(self.__records__), self.name))
+        self.store = ResultStore(self.directory)
+        for index, value in enumerate(self.__records__):
+            if hasattr(value, 'as_dict'):
+                data = dict(value.as_dict())
+            else:
+                data = dict(value)
+            self.__records__[index] = self.store.append(value.host, data)
+
+    def __iter__(self):
+        order = self.__order__
+        if order is None:
+            order = xrange(len(self.__records__))
+        for record in order:
+            yield self.load_record(record)
+
+    def __len__(self):
+        return len(self.__records__)
+
+    def __nonzero__(self):
+        return len(self.__records__) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.load_record(record) for record in self.__record_order__()[index]]
+        return self.load_record(self.__record_order__()[index])
+
+    def __record_order__(self):
+        if self.__order__ is None:
+            return range(len(self.__records__))
+        return self.__order__
+
+    @property
+    def spilled(self):
+        return self.store is not None
+
+    def append(self, host, result):
+        """Append a result
+
+        Returns the appended result
+        """
+        return self.append_record(host, result)[0]
+
+    def append_record(self, host, result):
+        """Append a result
+
+        Result is stored in memory, or written to the store if results were
+        spilled. Results are spilled when there are more than self.threshold
+        results.
+
+        Returns tuple (result, record), where record is the sequence number of
+        the result.
+        """
+        result = self.__update_facts__(host, result)
+        value = self.result_loader(self, host, result)
+        record = len(self.__records__)
+
+        if self.store is not None:
+            self.__records__.append(self.store.append(host, result))
+        else:
+            self.__records__.append(value)
+            if len(self.__records__) > self.threshold:
+                self.__spill__()
+
+        self.__hosts__.append(self.__sort_key__(host))
+        if self.__order__ is not None:
+            self.__order__.append(record)
+
+        if self.resultset.writers:
+            self.resultset.write_result(value)
+
+        return value, record
+
+    def load_record(self, record):
+        """Return result for sequence number record
+
+        Results in the store are loaded with self.result_loader
+        """
+        value = self.__records__[record]
+        if isinstance(value, (int, long)):
+            host, data = self.store.read(value)
+            return self.result_loader(self, host, data)
+        return value
+
+    def sort(self, cmp=None, key=None, reverse=False):
+        """Sort results
+
+        Accepts same arguments as list.sort. Only the iteration order of
+        records is sorted.
+
+        Without cmp and key, results are sorted by address and host name,
+        keeping the order of results of each host, and results are not loaded.
+        With key, each result is loaded once to compute its key. With cmp only,
+        all results are loaded to memory for sorting.
+        """
+        records = xrange(len(self.__records__))
+        if cmp is None and key is None:
+            keys = self.__hosts__
+        elif key is not None:
+            keys = [key(self.load_record(record)) for record in records]
+        else:
+            keys = [self.load_record(record) for record in records]
+        self.__order__ = sorted(records, cmp=cmp, key=keys.__getitem__, reverse=reverse)
+
+
+class HostEntries(object):
+    """Host entries loaded from records
+
+    Read only sequence of {'host': host, 'results': results} entries for host
+    index entries with result records of a SpillResultSet. Results of an entry
+    are loaded each time the entry is accessed.
+    """
+
+    def __init__(self, resultset, entries):
+        self.resultset = resultset
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __nonzero__(self):
+        return len(self.entries) > 0
+
+    def __load__(self, entry):
+        return {
+            'host': entry['host'],
+            'results': [self.resultset.load_record(record) for record in entry['results']],
+        }
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__load__(entry) for entry in self.entries[index]]
+        return self.__load__(self.entries[index])
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield self.__load__(entry)
+
+
+class ResultList(object):
+    """List of results
+
+    Parent class for collected results, with two result sets in self.results:
+
+    self.results['contacted'] = result set of contacted hosts
+    self.results['dark'] = result set of unreachable hosts
+
+    Note: a host may be in both sets if it was unreachable in middle of a playbook
+
+    Results are written to runner's result_writers (like NDJSONWriter) as they
+    are appended.
+    """
+
+    def __init__(self, runner, show_colors=False):
+        self.log = Logger().default_stream
+        self.runner = runner
+        self.show_colors = show_colors
+        self.writers = getattr(runner, 'result_writers', [])
+        self.current_task = None
+        self.host_table = HostTable()
+
+        self.results = {
+            'contacted': self.resultset_loader(self, 'contacted'),
+            'dark': self.resultset_loader(self, 'dark'),
+        }
+
+
+    @property
+    def resultset_loader(self):
+        return self.runner.resultset_loader
+
+    def write_result(self, result):
+        """Write result to result writers
+
+        Called by ResultSet.append for each new result
+        """
+        for writer in self.writers:
+            writer.write(result, task=self.current_task)
+
+    def sort(self):
+        """Sort results
+
+        Sorts the ResultSets contacted and dark
+
+        """
+        self.results['dark'].sort()
+        self.results['contacted'].sort()
+
+    def iter_host_output(self, formatter, json=False):
+        """Iterate formatted output by host
+
+        Yields (host, text) tuples for contacted and dark results, formatted
+        with formatter callback. Each result is one json document with a json
+        formatter, so json is not used here.
+        """
+        for result in self.results['contacted']:
+            yield result.host, formatter(result)
+        for result in self.results['dark']:
+            yield result.host, formatter(result)
+
+    def write_to_directory(self, directory, formatter, extension, threads=DEFAULT_WRITER_THREADS, json=False):
+        """Write results to directory by host
+
+        Write output for each host to a file in directory, with path like:
+
+          directory/<host>.<extension>
+
+        Output is formatted with formatter callback and written by a pool of
+        writer threads with DirectoryWriter. Set json when formatter returns
+        json, so each file is a single json document (see iter_host_output).
+
+        Raises RunnerError if writing any file failed.
+        """
+        writer = DirectoryWriter(directory, extension, threads)
+        try:
+            for host, text in self.iter_host_output(formatter, json=json):
+                writer.write(host, text)
+        finally:
+            writer.close()
+
+    def iter_archived_results(self):
+        """Iterate results for archive
+
+        Yields contacted and dark results
+        """
+        for result in self.results['contacted']:
+            yield result
+        for result in self.results['dark']:
+            yield result
+
+    def write_to_archive(self, path, command=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        """Write results to archive
+
+        Insert results to SQLite result archive in path as a new run, in
+        transactions of batch_size results. Command is stored with the run.
+
+        Returns run id of the archived run.
+
+        Raises RunnerError if writing the archive failed.
+        """
+        archive = ResultArchive(path, command=command or '', batch_size=batch_size)
+        try:
+            for result in self.iter_archived_results():
+                archive.write(result)
+        finally:
+            archive.close()
+        return archive.run_id
+
+    def to_json(self, indent=2):
+        """Return as json
+
+        Returns all results formatted to json
+
+        """
+        return encoder.dumps({
+                'contacted': list(self.results['contacted']),
+                'dark': list(self.results['dark']),
+            },
+            indent=indent
+        )
+
+    def __is_reported__(self, result):
+        """Check if result is reported in deduplicated output"""
+        return True
+
+    def __deduplication_key__(self, result):
+        """Return key of result output for deduplication
+
+        Results with ansible facts, from setup or any other module, are not
+        deduplicated.
+        """
+        if 'ansible_facts' in result:
+            return ( result.host, )
+        return ( result.status, result.returncode, result.stdout, result.stderr, result.error, )
+
+    def deduplicated(self, name):
+        """Return deduplicated results
+
+        Group results in result set name by status, return code, stdout, stderr
+        and error message in one pass over the results. Playbook results are
+        also grouped by task command.
+
+        Returns list of DeduplicatedResult objects, in order of first result of
+        each group.
+        """
+        groups = {}
+        deduplicated = []
+        for result in self.results[name]:
+            if not self.__is_reported__(result):
+                continue
+            key = self.__deduplication_key__(result)
+            group = groups.get(key, None)
+            if group is None:
+                group = groups[key] = DeduplicatedResult(result)
+                deduplicated.append(group)
+            else:
+                group.add_host(result.host)
+        return deduplicated
+
+    def deduplicated_json(self, indent=2):
+        """Return deduplicated results as json
+
+        Returns deduplicated contacted and dark results formatted to json
+        """
+        return encoder.dumps({
+                'contacted': self.deduplicated('contacted'),
+                'dark': self.deduplicated('dark'),
+            },
+            indent=indent
+        )
+
+    def write_deduplicated_to_file(self, filename, formatter=None, json=False):
+        """Write deduplicated results to file
+
+        Arguments
+          filename: target filename to write
+          formatter: callback to format each result group in text files
+          json: if set, formatter is ignored and self.deduplicated_json is used
+
+        Raises RunnerError if file writing failed.
+        """
+        if not formatter and not json:
+            raise RunnerError('Either formatter callback or json flag must be set')
+
+        try:
+            fd = open(filename, 'w')
+            if json:
+                fd.write('%s\n' % self.deduplicated_json())
+            else:
+                write_formatted(fd, self.deduplicated('contacted') + self.deduplicated('dark'), formatter)
+            fd.close()
+
+        except IOError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+        except OSError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+
+    def write_to_file(self, filename, formatter=None, json=False, ndjson=False):
+        """Write results to file
+
+        Arguments
+          filename: target filename to write
+          formatter: callback to format the file entry in text files
+          json: if set, formatter is ignored and self.to_json is used to write file
+          ndjson: if set, formatter is ignored and results are written one
+                  result per line with NDJSONWriter
+
+        Either formatter callback, json=True or ndjson=True is required
+
+        Raises RunnerError if file writing failed.
+        """
+
+        if not formatter and not json and not ndjson:
+            raise RunnerError('Either formatter callback, json or ndjson flag must be set')
+
+        if ndjson:
+            writer = NDJSONWriter(filename)
+            for result in self.results['contacted']:
+                writer.write(result)
+            for result in self.results['dark']:
+                writer.write(result)
+            writer.close()
+            return
+
+        try:
+            fd = open(filename, 'w')
+            if json:
+                fd.write('%s\n' % self.to_json())
+            elif formatter:
+                write_formatted(fd, itertools.chain(self.results['contacted'], self.results['dark']), formatter)
+
+            fd.close()
+
+        except IOError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+        except OSError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+
+
+class RunnerResults(ResultList):
+    """Runner results
+
+    Collect results from ansible runner output
+
+    """
+
+    def __init__(self, runner, results, show_colors=False):
+        ResultList.__init__(self, runner, show_colors)
+
+        for k in ( 'dark', 'contacted', ):
+            if k in results:
+                group = self.results[k]
+                for host, result in results[k].items():
+                    group.append(host, result)
+
+
+class PlaybookResults(ResultList, AggregateStats):
+    """Playbook results
+
+    Collect results from playbook runs, grouped by host
+
+    """
+
+    def __init__(self, runner, show_colors=False):
+        AggregateStats.__init__(self)
+        ResultList.__init__(self, runner, show_colors)
+
+        # Results by host, updated in self.compute()
+        self.__host_index__ = { 'contacted': {}, 'dark': {} }
+        self.__host_names__ = { 'contacted': [], 'dark': [] }
+        self.__host_entries__ = { 'contacted': [], 'dark': [] }
+
+    def __index_result__(self, name, result, record):
+        """Add result to host index
+
+        Add result record to results of the host in host index for result set
+        name. New hosts are inserted to the index sorted by host name.
+
+        Results from setup module are not indexed unless runner's show_facts
+        is set, but the host is added to the index.
+        """
+        entry = self.__host_index__[name].get(result.host, None)
+        if entry is None:
+            entry = {'host': result.host, 'results': []}
+            self.__host_index__[name][result.host] = entry
+            names = self.__host_names__[name]
+            position = bisect.bisect(names, result.host)
+            names.insert(position, result.host)
+            self.__host_entries__[name].insert(position, entry)
+
+        if result.module_name == 'setup' and not self.runner.show_facts:
+            return
+
+        entry['results'].append(record)
+
+    @property
+    def grouped_by_host(self):
+        """Return task output grouped by host
+
+        Return dictionary with contacted and dark keys, each containing a tuple
+        of {'host': host, 'results': results} entries sorted by host name.
+
+        The entries are a read only view to the host index and results are not
+        copied: the returned values must not be modified. For result sets with
+        stored records (SpillResultSet), the entries are a HostEntries sequence
+        loading results of each entry when accessed.
+        """
+        grouped = {}
+        for name in ( 'contacted', 'dark', ):
+            if self.results[name].stored_records:
+                grouped[name] = HostEntries(self.results[name], self.__host_entries__[name])
+            else:
+                grouped[name] = tuple(self.__host_entries__[name])
+        return grouped
+
+    def iter_host_output(self, formatter, json=False):
+        """Iterate formatted output by host
+
+        Yields (host, text) tuples with all task results of each host, formatted
+        with formatter callback. Results from contacted set are before results
+        from dark set. Results from setup module are skipped unless runner's
+        show_facts is set.
+
+        If json is set, formatter is not used, and text is the host entry
+        {'host': host, 'results': results} encoded as one json document.
+        """
+        contacted = self.__host_index__['contacted']
+        dark = self.__host_index__['dark']
+
+        for host in sorted(set(contacted.keys()) | set(dark.keys())):
+            results = []
+            if host in contacted:
+                resultset = self.results['contacted']
+                results.extend(resultset.load_record(record) for record in contacted[host]['results'])
+            if host in dark:
+                resultset = self.results['dark']
+                results.extend(resultset.load_record(record) for record in dark[host]['results'])
+            results = [result for result in results if self.__is_reported__(result)]
+            if not results:
+                continue
+            if json:
+                yield host, encoder.dumps({'host': host, 'results': results})
+            else:
+                yield host, '\n'.join(formatter(result) for result in results)
+
+    def task_start(self, name):
+        """Task started
+
+        Called by PlaybookCallbacks when a playbook task is started
+        """
+        self.current_task = name
+
+    def write_result(self, result):
+        """Write result to result writers
+
+        Results from setup module are skipped unless runner's show_facts is set
+        """
+        if result.module_name == 'setup' and not self.runner.show_facts:
+            return
+        ResultList.write_result(self, result)
+
+    def iter_archived_results(self):
+        """Iterate results for archive
+
+        Yields contacted and dark results. Results from setup module are
+        skipped unless runner's show_facts is set.
+        """
+        for result in ResultList.iter_archived_results(self):
+            if result.module_name == 'setup' and not self.runner.show_facts:
+                continue
+            yield result
+
+    def __is_reported__(self, result):
+        """Check if result is reported in deduplicated output
+
+        Results from setup module are skipped unless runner's show_facts is set
+        """
+        return result.module_name != 'setup' or self.runner.show_facts
+
+    def __deduplication_key__(self, result):
+        """Return key of result output for deduplication, including task command"""
+        return ( result.command, ) + ResultList.__deduplication_key__(self, result)
+
+    def compute(self, runner_results, setup=False, poll=False, ignore_errors=False):
+        """Import results
+
+        Override for default ansible playbook callback to import task results
+        to main process. You can't directly write from tasks without callback to
+        main process because they are running in separate processes launched by
+        multiprocess module.
+        """
+        for name in ( 'contacted', 'dark', ):
+            resultset = self.results[name]
+            for (host, value) in runner_results.get(name, {}).iteritems():
+                result, record = resultset.append_record(host, value)
+                if resultset.retains_results:
+                    self.__index_result__(name, result, record)
+
+    def summarize(self, host):
+        """Return summary
+
+        Return summary for a host.
+
+        TODO - fix this function to actually return what is expected. Right now
+        it does not and exists only to override ansible playbook default APIs
+        """
+        return { 'contacted': self.results['contacted'], 'dark': self.results['dark'], }
+
+    def iter_json(self, indent=2):
+        """Iterate results as json
+
+        Yields data from self.grouped_by_host in json format in chunks, encoding
+        one host entry at a time.
+        """
+        if encoder.default_encoder().compact:
+            indent = None
+
+        if indent:
+            pad = '\n' + ' ' * indent
+            entry_pad = '\n' + ' ' * indent * 2
+            separator = ': '
+        else:
+            pad = entry_pad = ''
+            separator = ':'
+
+        grouped = self.grouped_by_host
+        yield '{'
+        for i, name in enumerate(( 'contacted', 'dark', )):
+            yield '%s%s"%s"%s[' % (i and ',' or '', pad, name, separator)
+            for j, entry in enumerate(grouped[name]):
+                text = encoder.dumps(entry, indent=indent)
+                if indent:
+                    text = text.replace('\n', entry_pad)
+                yield '%s%s%s' % (j and ',' or '', entry_pad, text)
+            yield '%s]' % (grouped[name] and pad or '')
+        yield '%s}' % (indent and '\n' or '')
+
+    def to_json(self, indent=2):
+        """Return as json
+
+        Returns data in json format using self.grouped_by_host for ordering.
+        """
+        return ''.join(self.iter_json(indent=indent))
+
+    def write_to_file(self, filename, formatter=None, json=False, ndjson=False):
+        """Write results to file
 
         Arguments
           filename: target filename to write
           formatter: callback to format the file entry in text files
           json: if set, formatter is ignored and self.to_json is used to write file
+          ndjson: if set, formatter is ignored and results are written one
+                  result per line with NDJSONWriter
 
-        Either formatter callback or json=True is required
+        Either formatter callback, json=True or ndjson=True is required
 
         Raises RunnerError if file writing failed.
         """
 
-        if not formatter and not json:
-            raise RunnerError('Either formatter callback or json flag must be set')
+        if not formatter and not json and not ndjson:
+            raise RunnerError('Either formatter callback, json or ndjson flag must be set')
+
+        if ndjson:
+            writer = NDJSONWriter(filename)
+            for result in self.results['contacted']:
+                if result.module_name == 'setup' and not self.runner.show_facts:
+                    continue
+                writer.write(result)
+            for result in self.results['dark']:
+                if result.module_name == 'setup' and not self.runner.show_facts:
+                    continue
+                writer.write(result)
+            writer.close()
+            return
 
         try:
             fd = open(filename, 'w')
             if json:
-                fd.write('%s\n' % self.to_json())
+                for chunk in self.iter_json():
+                    fd.write(chunk)
+                fd.write('\n')
             elif formatter:
-                for result in self.results['contacted']:
-                    if result.module_name == 'setup' and not self.runner.show_facts:
-                        continue
-                    fd.write('%s\n' % formatter(result))
-                for result in self.results['dark']:
-                    if result.module_name == 'setup' and not self.runner.show_facts:
-                        continue
-                    fd.write('%s\n' % formatter(result))
+                write_formatted(fd, (
+                    result for result in itertools.chain(self.results['contacted'], self.results['dark'])
+                    if result.module_name != 'setup' or self.runner.show_facts
+                ), formatter)
             fd.close()
 
         except IOError, (ecode, emsg):
@@ -655,6 +2216,24 @@ class PlaybookResults(ResultList, AggregateStats):
             raise RunnerError('Error writing file %s: %s' % (filename, emsg))
 
 
+# AnsibleRunner running hosts in worker pool processes
+pool_runner = None
+
+
+def pool_initializer():
+    """Ignore interrupts in pool workers, like ansible forks"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def pool_execute(host):
+    """Run pool_runner on host in pool worker
+
+    Returns tuple (host, communicated ok, result data)
+    """
+    value = pool_runner._executor(host, None)
+    return host, value.communicated_ok(), value.result
+
+
 class AnsibleRunner(Runner):
     """Ansible Runner reporter
 
@@ -667,17 +2246,618 @@ class AnsibleRunner(Runner):
 
     def __init__(self, *args, **kwargs):
         self.show_colors = kwargs.pop('show_colors', False)
+        self.result_loader = kwargs.pop('result_loader', self.result_loader)
+        self.result_writers = kwargs.pop('result_writers', [])
+        self.result_cache = kwargs.pop('result_cache', None)
+        self.facts_cache = kwargs.pop('facts_cache', None)
+        if not kwargs.pop('retain_results', True):
+            self.resultset_loader = StreamResultSet
         Runner.__init__(self, *args, **kwargs)
 
+    def __cache_key__(self, host):
+        """Return result cache key for host
+
+        Key contains module name and arguments, remote user, sudo and su users
+        and hash of inventory variables for the host.
+        """
+        return (
+            self.module_name,
+            self.module_args,
+            getattr(self, 'remote_user', None),
+            getattr(self, 'sudo', False) and getattr(self, 'sudo_user', None) or None,
+            getattr(self, 'su', False) and getattr(self, 'su_user', None) or None,
+            variables_hash(self.inventory.get_variables(host)),
+        )
+
+    def __run_hosts__(self):
+        """Run ansible command on hosts
+
+        Run ansible command with Runner.run, returning the raw results.
+
+        If self.result_cache is set, hosts with fresh cached results are not
+        run and the cached results are merged to contacted results. Successful
+        results from contacted hosts are stored to the cache.
+        """
+        if self.result_cache is None:
+            return Runner.run(self)
+
+        run_hosts = self.run_hosts
+        hosts = run_hosts or self.inventory.list_hosts(self.pattern)
+        keys, cached, uncached = self.__cached_results__(hosts)
+
+        if uncached:
+            # Runner.run runs all hosts in pattern if run_hosts is empty
+            self.run_hosts = uncached
+            try:
+                results = Runner.run(self)
+            finally:
+                self.run_hosts = run_hosts
+        else:
+            results = {'contacted': {}, 'dark': {}}
+
+        for host, value in results.get('contacted', {}).items():
+            self.__cache_result__(keys, host, value)
+
+        results.setdefault('contacted', {}).update(cached)
+        return results
+
+    def __cached_results__(self, hosts):
+        """Look up cached results of hosts
+
+        Returns tuple (keys, cached, uncached) with dictionary of cache keys by
+        host, dictionary of cached results by host and list of hosts without
+        fresh cached results.
+        """
+        keys = {}
+        cached = {}
+        uncached = []
+        for host in hosts:
+            keys[host] = self.__cache_key__(host)
+            value = self.result_cache.get(host, keys[host])
+            if value is not None:
+                cached[host] = value
+            else:
+                uncached.append(host)
+        return keys, cached, uncached
+
+    def __cache_result__(self, keys, host, value):
+        """Store successful result of contacted host to the result cache"""
+        if host in keys and not value.get('failed', False) and value.get('rc', 0) == 0:
+            self.result_cache.set(host, keys[host], value)
+
     def run(self):
         """Run ansible command and process results
 
         Run ansible command, returning output processed with
         self.process_results.
         """
-        results = Runner.run(self)
+        try:
+            results = self.__run_hosts__()
+        finally:
+            if self.result_cache is not None:
+                self.result_cache.prune()
+        return self.process_results(results, show_colors=self.show_colors)
+
+    def iter_raw_results(self, hosts):
+        """Run ansible command on hosts and iterate results
+
+        Hosts are run by a pool of self.forks worker processes, one host at a
+        time, and results are yielded in the order the hosts finish. Action
+        plugins which run once for all hosts, run_once and runs with one fork
+        are run with Runner.run, and results are yielded when all hosts are
+        finished.
+
+        Yields (resultset name, host, data) tuples in ansible runner result
+        format.
+        """
+        global pool_runner
+
+        keys = {}
+        if self.result_cache is not None:
+            keys, cached, hosts = self.__cached_results__(hosts)
+            for host in sorted(cached, key=result_sort_key):
+                yield 'contacted', host, cached[host]
+        if not hosts:
+            return
+
+        plugin = utils.plugins.action_loader.get(self.module_name, self)
+        if self.forks <= 1 or len(hosts) == 1 or self.run_once or getattr(plugin, 'BYPASS_HOST_LOOP', False):
+            run_hosts = self.run_hosts
+            forks = self.forks
+            self.run_hosts = hosts
+            try:
+                results = Runner.run(self)
+            finally:
+                self.run_hosts = run_hosts
+                self.forks = forks
+
+            for name in ( 'contacted', 'dark', ):
+                values = results.get(name, {})
+                for host in sorted(values, key=result_sort_key):
+                    if name == 'contacted' and self.result_cache is not None:
+                        self.__cache_result__(keys, host, values[host])
+                    yield name, host, values[host]
+            return
+
+        # Pool workers are forked with the runner in pool_runner
+        pool_runner = self
+        pool = multiprocessing.Pool(min(self.forks, len(hosts)), pool_initializer)
+        try:
+            for host, communicated_ok, value in pool.imap_unordered(pool_execute, hosts):
+                if not communicated_ok:
+                    yield 'dark', host, value
+                    continue
+                if self.result_cache is not None:
+                    self.__cache_result__(keys, host, value)
+                yield 'contacted', host, value
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            pool_runner = None
+
+    def iter_results(self, batch_size=None):
+        """Run ansible command and iterate results
+
+        Yields Result objects as soon as each host is finished, see
+        iter_raw_results. Each result contains all output of a host, so output
+        from hosts is never interleaved. Results are loaded to a new result
+        list for each batch_size results (defaults to number of forks), so only
+        results of the current batch are kept in memory.
+        """
+        hosts = self.run_hosts or self.inventory.list_hosts(self.pattern)
+        if not hosts:
+            self.callbacks.on_no_hosts()
+            return
+
+        if batch_size is None:
+            batch_size = self.forks
+        batch_size = max(1, int(batch_size))
+
+        results = None
+        try:
+            for index, (name, host, value) in enumerate(self.iter_raw_results(hosts)):
+                if index % batch_size == 0:
+                    results = self.process_results({}, show_colors=self.show_colors)
+                yield results.results[name].append(host, value)
+        finally:
+            if self.result_cache is not None:
+                self.result_cache.prune()
+
+    def process_results(self, results, show_colors=False):
+        """Process collected results
+
+        Called from self.run(), processes collected results.
+
+        Default implementation just sorts the results. Override to
+        do more fancy processing.
+        """
+        return self.resultlist_loader(self, results, show_colors)
+
+
+class ShardedRunner(object):
+    """Sharded ansible runner
+
+    Split hosts matching runner pattern to shards and run each shard in a
+    separate worker process with its own runner_class (AnsibleRunner) instance
+    and fork budget. Each worker sorts the results of its shard, and results
+    are merged to one RunnerResults in sorted order with a k-way merge.
+
+    Keyword arguments are passed to runner_class. Result writers receive the
+    results in the parent process when the results are merged.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, runner_class=None, tempdir=None, **kwargs):
+        self.shards = max(1, int(shards))
+        self.runner_class = runner_class is not None and runner_class or AnsibleRunner
+        self.tempdir = tempdir
+        self.kwargs = kwargs
+
+        # Runner in parent process to match hosts and load merged results
+        self.runner = self.runner_class(**kwargs)
+
+    @property
+    def show_colors(self):
+        return self.runner.show_colors
+
+    def __split_hosts__(self, hosts):
+        """Split hosts to self.shards shards of nearly equal size"""
+        shards = []
+        size, extra = divmod(len(hosts), self.shards)
+        index = 0
+        for shard in range(self.shards):
+            count = size + (shard < extra and 1 or 0)
+            if count:
+                shards.append(hosts[index:index+count])
+            index += count
+        return shards
+
+    def __run_shard__(self, hosts, path):
+        """Run shard in worker process
+
+        Run runner_class with hosts and write the results of each result set,
+        sorted by host address and name, to path as a pickled dictionary.
+        """
+        kwargs = dict(self.kwargs)
+        kwargs['result_writers'] = []
+        kwargs['run_hosts'] = hosts
+
+        try:
+            runner = self.runner_class(**kwargs)
+            raw = runner.__run_hosts__()
+            results = {}
+            for name in ( 'contacted', 'dark', ):
+                items = raw.get(name, {}).items()
+                items.sort(key=lambda item: result_sort_key(item[0]))
+                results[name] = items
+            value = { 'results': results }
+        except Exception, emsg:
+            value = { 'error': '%s' % emsg }
+
+        fd = open(path, 'wb')
+        cPickle.dump(value, fd, cPickle.HIGHEST_PROTOCOL)
+        fd.close()
+
+    def __merge__(self, shard_results):
+        """Merge sorted shard results
+
+        Merge sorted (host, data) lists from shards with heapq.merge, appending
+        results to a new result list in sorted order.
+        """
+        results = self.runner.process_results({}, show_colors=self.show_colors)
+        for name in ( 'contacted', 'dark', ):
+            iterators = []
+            for index, shard in enumerate(shard_results):
+                iterators.append(
+                    (result_sort_key(host), index, host, data) for host, data in shard[name]
+                )
+            resultset = results.results[name]
+            for key, index, host, data in heapq.merge(*iterators):
+                resultset.append(host, data)
+        return results
+
+    def run(self):
+        """Run ansible command in shards
+
+        Run shards in worker processes and return merged results, sorted by
+        result set.
+
+        Raises RunnerError if any shard failed.
+        """
+        hosts = self.runner.run_hosts or self.runner.inventory.list_hosts(self.runner.pattern)
+        shards = self.__split_hosts__(hosts)
+
+        workers = []
+        try:
+            for shard in shards:
+                fd, path = tempfile.mkstemp(prefix='ansible-shard-', suffix='.results', dir=self.tempdir)
+                os.close(fd)
+                process = multiprocessing.Process(target=self.__run_shard__, args=(shard, path))
+                workers.append((process, path))
+                process.start()
+
+            shard_results = []
+            for process, path in workers:
+                process.join()
+                try:
+                    value = cPickle.load(open(path, 'rb'))
+                except (IOError, EOFError, cPickle.UnpicklingError):
+                    raise RunnerError('Shard worker exited with code %s without results' % process.exitcode)
+                if 'error' in value:
+                    raise RunnerError(value['error'])
+                shard_results.append(value['results'])
+
+        finally:
+            for process, path in workers:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            if self.runner.result_cache is not None:
+                self.runner.result_cache.prune()
+
+        return self.__merge__(shard_results)
+
+    def iter_results(self, batch_size=None):
+        """Run ansible command in shards and iterate merged results
+
+        Results are only available when all shards have finished
+        """
+        results = self.run()
+        for result in results.results['contacted']:
+            yield result
+        for result in results.results['dark']:
+            yield result
+
+
+class HostCommand(object):
+    """Command running on a host
+
+    State of a command started by AsyncRunner: the process, output collected
+    from its stdout and stderr pipes and start time.
+    """
+    __slots__ = ( 'host', 'process', 'start', 'deadline', 'output', 'open_pipes', )
+
+    def __init__(self, host, process, timeout=None):
+        self.host = host
+        self.process = process
+        self.start = datetime.now()
+        self.deadline = timeout and time.time() + timeout or None
+        self.output = {
+            process.stdout.fileno(): [],
+            process.stderr.fileno(): [],
+        }
+        self.open_pipes = 2
+
+    @property
+    def finished(self):
+        return self.open_pipes == 0
+
+    def close(self):
+        """Close the output pipes"""
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+    @property
+    def stdout(self):
+        return ''.join(self.output[self.process.stdout.fileno()])
+
+    @property
+    def stderr(self):
+        return ''.join(self.output[self.process.stderr.fileno()])
+
+
+class AsyncRunner(object):
+    """Asynchronous command runner
+
+    Run shell commands on hosts matching pattern from a single process, with
+    up to concurrency commands in flight. Commands are started with transport
+    (SSHTransport by default) as child processes, and their output is read
+    with one poll loop, so the number of hosts in flight is not limited by
+    the number of forks.
+
+    Commands are run on run_hosts, or hosts matching pattern in inventory if
+    run_hosts is not given. Supported modules are shell and raw, which run
+    module_args as a shell command, command, which runs module_args split to
+    arguments without shell processing, and ping. Results are collected to
+    the same RunnerResults and Result objects as with AnsibleRunner.
+
+    Concurrency is limited to the number of commands the open files limit
+    allows. Commands still running after command_timeout seconds are killed
+    and the host is reported as unreachable.
+    """
+    resultlist_loader = RunnerResults
+    resultset_loader = ResultSet
+    result_loader = Result
+    supported_modules = ( 'command', 'shell', 'raw', 'ping', )
+
+    def __init__(self, host_list=None, pattern='all', module_name='command', module_args='',
+                 inventory=None, run_hosts=None, transport=None, concurrency=DEFAULT_ASYNC_CONCURRENCY,
+                 sudo=False, sudo_user=None, show_colors=False, result_loader=None, result_writers=None,
+                 facts_cache=None, command_timeout=None, retain_results=True):
+
+        if module_name not in self.supported_modules:
+            raise RunnerError('Module not supported by asynchronous runner: %s' % module_name)
+
+        self.log = Logger().default_stream
+
+        self.inventory = inventory is not None and inventory or Inventory(host_list)
+        self.run_hosts = run_hosts
+        self.pattern = pattern
+        self.module_name = module_name
+        self.module_args = module_args
+        self.transport = transport is not None and transport or SSHTransport()
+        self.concurrency = max(1, int(concurrency))
+        self.command_timeout = command_timeout
+        self.sudo = sudo
+        self.sudo_user = sudo_user
+        self.show_colors = show_colors
+        self.result_loader = result_loader is not None and result_loader or self.result_loader
+        self.result_writers = result_writers is not None and result_writers or []
+        self.facts_cache = facts_cache
+        if not retain_results:
+            self.resultset_loader = StreamResultSet
+
+    @property
+    def remote_command(self):
+        """Shell command run on hosts"""
+        if self.module_name == 'ping':
+            command = 'true'
+        elif self.module_name == 'command':
+            command = argv_command(self.module_args)
+        else:
+            command = self.module_args
+        if self.sudo:
+            command = sudo_command(command, self.sudo_user or 'root')
+        return command
+
+    def __start__(self, host, command, devnull, retry=False):
+        """Start command on host
+
+        Returns HostCommand, or None if retry is set and the process is out
+        of file descriptors.
+        """
+        argv = self.transport.command(host, self.inventory.get_variables(host), command)
+        try:
+            process = subprocess.Popen(argv,
+                stdin=devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+            )
+        except OSError, (ecode, emsg):
+            if retry and ecode in ( errno.EMFILE, errno.ENFILE, ):
+                return None
+            raise RunnerError('Error running %s: %s' % (argv[0], emsg))
+        return HostCommand(host, process, self.command_timeout)
+
+    def __timeout__(self, command):
+        """Kill timed out command
+
+        Returns tuple (resultset name, data) in ansible runner result format
+        """
+        if command.process.poll() is None:
+            command.process.kill()
+        command.process.wait()
+        return 'dark', {
+            'failed': True,
+            'msg': 'Command timed out after %s seconds' % self.command_timeout,
+        }
+
+    def __result__(self, command):
+        """Return result for finished command
+
+        Returns tuple (resultset name, data) in ansible runner result format
+        """
+        returncode = command.process.wait()
+        end = datetime.now()
+        invocation = { 'module_name': self.module_name, 'module_args': self.module_args }
+
+        if returncode == self.transport.unreachable_returncode:
+            return 'dark', {
+                'failed': True,
+                'msg': command.stderr.strip() or 'Host unreachable',
+            }
+
+        if self.module_name == 'ping':
+            if returncode != 0:
+                return 'contacted', {
+                    'failed': True,
+                    'msg': command.stderr.strip(),
+                    'invocation': invocation,
+                }
+            return 'contacted', {
+                'ping': 'pong',
+                'changed': False,
+                'invocation': invocation,
+            }
+
+        return 'contacted', {
+            'cmd': self.module_args,
+            'rc': returncode,
+            'stdout': command.stdout.rstrip('\r\n'),
+            'stderr': command.stderr.rstrip('\r\n'),
+            'start': command.start.strftime(RESULT_DATE_FORMAT),
+            'end': end.strftime(RESULT_DATE_FORMAT),
+            'delta': str(end - command.start),
+            'changed': True,
+            'invocation': invocation,
+        }
+
+    def iter_raw_results(self):
+        """Run command on hosts and iterate results
+
+        Yields (resultset name, host, data) tuples in ansible runner result
+        format in the order the commands finish.
+        """
+        hosts = collections.deque(self.run_hosts or self.inventory.list_hosts(self.pattern))
+        remote_command = self.remote_command
+        commands = {}
+        running = 0
+        poller = select.poll()
+        devnull = open(os.devnull, 'r')
+
+        # Commands in start order, for finding commands past their deadline
+        started = collections.deque()
+
+        concurrency = self.concurrency
+        limit = file_limit_concurrency()
+        if limit is not None and limit < concurrency:
+            self.log.debug('limiting concurrency to %d by open files limit' % limit)
+            concurrency = limit
+
+        try:
+            while hosts or running:
+                while hosts and running < concurrency:
+                    command = self.__start__(hosts[0], remote_command, devnull, retry=running > 0)
+                    if command is None:
+                        # Out of file descriptors, start more commands when running commands finish
+                        self.log.debug('limiting concurrency to %d by available file descriptors' % running)
+                        concurrency = running
+                        break
+
+                    hosts.popleft()
+                    for fd in command.output.keys():
+                        commands[fd] = command
+                        poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+                    if command.deadline is not None:
+                        started.append(command)
+                    running += 1
+
+                now = time.time()
+                while started and (started[0].finished or started[0].deadline <= now):
+                    command = started.popleft()
+                    if command.finished:
+                        continue
+
+                    for fd in command.output.keys():
+                        if fd in commands:
+                            poller.unregister(fd)
+                            del commands[fd]
+                    command.open_pipes = 0
+                    running -= 1
+                    name, result = self.__timeout__(command)
+                    command.close()
+                    yield name, command.host, result
+
+                for fd, event in poller.poll(POLL_INTERVAL):
+                    command = commands[fd]
+                    try:
+                        data = os.read(fd, PIPE_READ_SIZE)
+                    except OSError:
+                        data = ''
+
+                    if data:
+                        command.output[fd].append(data)
+                        continue
+
+                    poller.unregister(fd)
+                    del commands[fd]
+                    command.open_pipes -= 1
+                    if command.open_pipes == 0:
+                        running -= 1
+                        name, result = self.__result__(command)
+                        command.close()
+                        yield name, command.host, result
+
+        finally:
+            for command in set(commands.values()):
+                if command.process.poll() is None:
+                    command.process.kill()
+                    command.process.wait()
+            devnull.close()
+
+    def run(self):
+        """Run command and process results
+
+        Run command on all hosts, returning output processed with
+        self.process_results.
+        """
+        results = { 'contacted': {}, 'dark': {} }
+        for name, host, result in self.iter_raw_results():
+            results[name][host] = result
         return self.process_results(results, show_colors=self.show_colors)
 
+    def iter_results(self, batch_size=None):
+        """Run command and iterate results
+
+        Yields Result objects as soon as commands finish. Results are loaded
+        to a new result list for each batch_size results (defaults to
+        concurrency), so only results of the current batch are kept in memory.
+        """
+        if batch_size is None:
+            batch_size = self.concurrency
+        batch_size = max(1, int(batch_size))
+
+        results = None
+        for index, (name, host, result) in enumerate(self.iter_raw_results()):
+            if index % batch_size == 0:
+                results = self.process_results({}, show_colors=self.show_colors)
+            yield results.results[name].append(host, result)
+
     def process_results(self, results, show_colors=False):
         """Process collected results
 
@@ -702,9 +2882,18 @@ class PlaybookRunner(PlayBook):
     def __init__(self, *args, **kwargs):
         self.show_colors = kwargs.pop('show_colors', False)
         self.show_facts = kwargs.pop('show_facts', False)
+        self.result_loader = kwargs.pop('result_loader', self.result_loader)
+        self.result_writers = kwargs.pop('result_writers', [])
+        self.facts_cache = kwargs.pop('facts_cache', None)
+        self.spill_threshold = kwargs.pop('spill_threshold', None)
+        self.spill_directory = kwargs.pop('spill_directory', None)
+        if self.spill_threshold is not None:
+            self.resultset_loader = SpillResultSet
+        if not kwargs.pop('retain_results', True):
+            self.resultset_loader = StreamResultSet
 
         self.results = self.resultlist_loader(self, self.show_colors)
-        self.callbacks = PlaybookCallbacks()
+        self.callbacks = PlaybookCallbacks(stats=self.results)
         self.runner_callbacks = PlaybookRunnerCallbacks(self.results)
 
         kwargs['callbacks'] =self.callbacks
@@ -712,6 +2901,36 @@ class PlaybookRunner(PlayBook):
         kwargs['stats'] = self.results
         PlayBook.__init__(self, *args, **kwargs)
 
+    def _do_setup_step(self, play):
+        """Gather facts for play
+
+        If self.facts_cache is set, facts for hosts with fresh cached facts are
+        loaded to ansible setup cache and setup module is only run on the other
+        hosts of the play.
+        """
+        if self.facts_cache is None or play.gather_facts is False:
+            return PlayBook._do_setup_step(self, play)
+
+        play_hosts = play._play_hosts
+        uncached = []
+        for host in play_hosts:
+            facts = self.results.results['contacted'].ansible_facts.gathered(host)
+            if facts is not None:
+                utils.update_hash(self.SETUP_CACHE, host, {'module_setup': True})
+                utils.update_hash(self.SETUP_CACHE, host, facts)
+            else:
+                uncached.append(host)
+
+        # Runner runs all hosts in pattern if the host list is empty
+        if not uncached:
+            return {}
+
+        play._play_hosts = uncached
+        try:
+            return PlayBook._do_setup_step(self, play)
+        finally:
+            play._play_hosts = play_hosts
+
     def run(self):
         """Run playbook
 
@@ -0,0 +1,66 @@
+"""
+Append-only on-disk result store
+
+Results of large playbook runs are spilled to a temporary store file, keeping
+only file offsets of the records in memory.
+"""
+
+import os
+import cPickle
+import tempfile
+
+from ansiblereporter import RunnerError
+
+DEFAULT_SPILL_THRESHOLD = 100000
+
+
+class ResultStore(object):
+    """Append-only result store
+
+    Records are pickled to a temporary file in directory (defaults to system
+    temporary directory). The file is removed as soon as it is opened, so it is
+    cleaned up when the store is closed or the process exits.
+
+    Raises RunnerError if the store file can't be created or accessed.
+    """
+
+    def __init__(self, directory=None):
+        self.records = 0
+        self.size = 0
+
+        try:
+            fd, path = tempfile.mkstemp(prefix='ansible-reporter-', suffix='.results', dir=directory)
+            self.fd = os.fdopen(fd, 'w+b')
+            os.unlink(path)
+        except (IOError, OSError), (ecode, emsg):
+            raise RunnerError('Error creating result store in %s: %s' % (directory or tempfile.gettempdir(), emsg))
+
+    def append(self, host, data):
+        """Append a record
+
+        Returns offset of the record in store file
+        """
+        try:
+            self.fd.seek(self.size)
+            cPickle.dump((host, data), self.fd, cPickle.HIGHEST_PROTOCOL)
+            offset = self.size
+            self.size = self.fd.tell()
+        except (IOError, OSError), (ecode, emsg):
+            raise RunnerError('Error writing result store: %s' % emsg)
+
+        self.records += 1
+        return offset
+
+    def read(self, offset):
+        """Read a record
+
+        Returns (host, data) tuple stored at offset
+        """
+        try:
+            self.fd.seek(offset)
+            return cPickle.load(self.fd)
+        except (IOError, OSError), (ecode, emsg):
+            raise RunnerError('Error reading result store: %s' % emsg)
+
+    def close(self):
+        self.fd.close()
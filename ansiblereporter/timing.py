@@ -0,0 +1,220 @@
+"""
+Task and host timing statistics from result start and end times
+
+TimingStats is used as a result writer, so it receives results with the
+playbook task name as they are collected.
+"""
+
+import math
+
+from ansiblereporter import RunnerError
+from ansiblereporter import encoder
+
+TIMING_PERCENTILES = ( 50, 95, 99, )
+DEFAULT_SLOWEST_HOSTS = 10
+
+
+def percentile(values, value):
+    """Return percentile
+
+    Return nearest rank percentile value from sorted list of values
+    """
+    if not values:
+        return None
+    index = int(math.ceil(value / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def prometheus_label(value):
+    """Escape prometheus label value"""
+    return ('%s' % value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class TimingStats(object):
+    """Timing statistics
+
+    Collects task durations from Result.delta for each task and host, and
+    earliest start and latest end time of all results.
+
+    Results without start and end time (unreachable hosts, failed modules) are
+    counted, but not included in durations.
+    """
+
+    def __init__(self, slowest_hosts=DEFAULT_SLOWEST_HOSTS):
+        self.slowest_hosts_count = slowest_hosts
+        self.results = 0
+        self.start = None
+        self.end = None
+        self.tasks = []
+        self.task_durations = {}
+        self.host_durations = {}
+
+    def write(self, result, task=None):
+        """Add result
+
+        Add timing of result to statistics. Same signature as result writers,
+        so TimingStats can be used in runner result_writers. If task is None,
+        result command is used as task name.
+        """
+        self.results += 1
+
+        start = result.start
+        end = result.end
+        if start is None or end is None:
+            return
+
+        if self.start is None or start < self.start:
+            self.start = start
+        if self.end is None or end > self.end:
+            self.end = end
+
+        if task is None:
+            task = result.command
+
+        if task not in self.task_durations:
+            self.tasks.append(task)
+            self.task_durations[task] = []
+
+        duration = (end - start).total_seconds()
+        self.task_durations[task].append(duration)
+        self.host_durations[result.host] = self.host_durations.get(result.host, 0) + duration
+
+    def close(self):
+        pass
+
+    @property
+    def wall_clock(self):
+        """Seconds from earliest start to latest end of results"""
+        if self.start is None or self.end is None:
+            return 0.0
+        return (self.end - self.start).total_seconds()
+
+    @property
+    def host_seconds(self):
+        """Sum of task durations of all hosts in seconds"""
+        return sum(self.host_durations.values())
+
+    @property
+    def task_latencies(self):
+        """Return task latencies
+
+        Return list of dictionaries with count, sum, max and percentiles in
+        TIMING_PERCENTILES of task durations, in task order.
+        """
+        latencies = []
+        for task in self.tasks:
+            values = sorted(self.task_durations[task])
+            entry = {
+                'task': task,
+                'count': len(values),
+                'sum': sum(values),
+                'max': values[-1],
+            }
+            for value in TIMING_PERCENTILES:
+                entry['p%d' % value] = percentile(values, value)
+            latencies.append(entry)
+        return latencies
+
+    @property
+    def slowest_hosts(self):
+        """Return slowest hosts
+
+        Return list of (host, seconds) tuples for hosts with largest sum of
+        task durations.
+        """
+        hosts = sorted(self.host_durations.items(), key=lambda x: (-x[1], x[0]))
+        return hosts[:self.slowest_hosts_count]
+
+    def as_dict(self):
+        return {
+            'results': self.results,
+            'wall_clock': self.wall_clock,
+            'host_seconds': self.host_seconds,
+            'tasks': self.task_latencies,
+            'slowest_hosts': [{'host': host, 'seconds': seconds} for host, seconds in self.slowest_hosts],
+        }
+
+    def summary(self):
+        """Return summary lines
+
+        Return timing summary as list of text lines
+        """
+        lines = [
+            'Timing summary for %d results' % self.results,
+            '  wall clock %.3fs, summed host time %.3fs' % (self.wall_clock, self.host_seconds),
+        ]
+
+        latencies = self.task_latencies
+        if latencies:
+            lines.append('  %8s %8s %8s %8s %8s  %s' % ('count', 'p50', 'p95', 'p99', 'max', 'task'))
+            for entry in latencies:
+                lines.append('  %8d %8.3f %8.3f %8.3f %8.3f  %s' % (
+                    entry['count'], entry['p50'], entry['p95'], entry['p99'], entry['max'], entry['task']
+                ))
+
+        hosts = self.slowest_hosts
+        if hosts:
+            lines.append('  slowest hosts:')
+            for host, seconds in hosts:
+                lines.append('  %8.3fs %s' % (seconds, host))
+
+        return lines
+
+    def to_json(self, indent=2):
+        """Return as json"""
+        return encoder.dumps(self.as_dict(), indent=indent)
+
+    def to_prometheus(self):
+        """Return as prometheus text format"""
+        lines = [
+            '# HELP ansible_task_duration_seconds Task duration on hosts',
+            '# TYPE ansible_task_duration_seconds summary',
+        ]
+        for entry in self.task_latencies:
+            task = prometheus_label(entry['task'])
+            for value in TIMING_PERCENTILES:
+                lines.append('ansible_task_duration_seconds{task="%s",quantile="%s"} %f' % (
+                    task, value / 100.0, entry['p%d' % value]
+                ))
+            lines.append('ansible_task_duration_seconds_sum{task="%s"} %f' % (task, entry['sum']))
+            lines.append('ansible_task_duration_seconds_count{task="%s"} %d' % (task, entry['count']))
+
+        lines.extend([
+            '# HELP ansible_host_duration_seconds Sum of task durations for slowest hosts',
+            '# TYPE ansible_host_duration_seconds gauge',
+        ])
+        for host, seconds in self.slowest_hosts:
+            lines.append('ansible_host_duration_seconds{host="%s"} %f' % (prometheus_label(host), seconds))
+
+        lines.extend([
+            '# HELP ansible_run_wall_clock_seconds Time from first task start to last task end',
+            '# TYPE ansible_run_wall_clock_seconds gauge',
+            'ansible_run_wall_clock_seconds %f' % self.wall_clock,
+            '# HELP ansible_run_host_seconds Sum of task durations on all hosts',
+            '# TYPE ansible_run_host_seconds gauge',
+            'ansible_run_host_seconds %f' % self.host_seconds,
+            '# HELP ansible_run_results Number of results',
+            '# TYPE ansible_run_results gauge',
+            'ansible_run_results %d' % self.results,
+        ])
+        return '\n'.join(lines)
+
+    def write_to_file(self, filename, prometheus=False):
+        """Write statistics to file
+
+        Write statistics as json, or prometheus text format if prometheus is set.
+
+        Raises RunnerError if file writing failed.
+        """
+        try:
+            fd = open(filename, 'w')
+            if prometheus:
+                fd.write('%s\n' % self.to_prometheus())
+            else:
+                fd.write('%s\n' % self.to_json())
+            fd.close()
+
+        except IOError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
+        except OSError, (ecode, emsg):
+            raise RunnerError('Error writing file %s: %s' % (filename, emsg))
@@ -0,0 +1,120 @@
+"""
+Command transports for AsyncRunner
+
+A transport returns the command line used to run a shell command on a host.
+SSHTransport runs commands with ssh, LocalTransport runs them locally and is
+used for testing without ansible hosts.
+"""
+
+import pipes
+import shlex
+
+from ansiblereporter import RunnerError
+
+DEFAULT_SSH_COMMAND = 'ssh'
+
+
+class LocalTransport(object):
+    """Local transport
+
+    Run commands locally with /bin/sh. Hosts are always reachable.
+
+    Transports return argument list to run shell command on host from
+    command(). If command exits with unreachable_returncode, the host was
+    not reachable.
+    """
+    name = 'local'
+    unreachable_returncode = None
+
+    def command(self, host, variables, command):
+        """Return command line
+
+        Return argument list to run shell command on host, with host inventory
+        variables in variables.
+        """
+        return [ '/bin/sh', '-c', command ]
+
+
+class SSHTransport(object):
+    """SSH transport
+
+    Run commands with ssh in batch mode. Host address, port and user are read
+    from ansible_ssh_host, ansible_ssh_port and ansible_ssh_user inventory
+    variables, defaulting to host name and transport arguments.
+
+    Exit code 255 from ssh is reported as unreachable host.
+    """
+    name = 'ssh'
+    unreachable_returncode = 255
+
+    def __init__(self, remote_user=None, remote_port=None, private_key_file=None, timeout=None,
+                 ssh_command=DEFAULT_SSH_COMMAND, ssh_args=None):
+        self.remote_user = remote_user
+        self.remote_port = remote_port
+        self.private_key_file = private_key_file
+        self.timeout = timeout
+        self.ssh_command = ssh_command
+        self.ssh_args = ssh_args is not None and list(ssh_args) or []
+
+    def command(self, host, variables, command):
+        argv = [ self.ssh_command, '-o', 'BatchMode=yes' ]
+        if self.timeout:
+            argv.extend([ '-o', 'ConnectTimeout=%d' % self.timeout ])
+
+        port = variables.get('ansible_ssh_port', self.remote_port)
+        if port:
+            argv.extend([ '-p', '%s' % port ])
+
+        user = variables.get('ansible_ssh_user', self.remote_user)
+        if user:
+            argv.extend([ '-l', user ])
+
+        if self.private_key_file:
+            argv.extend([ '-i', self.private_key_file ])
+
+        argv.extend(self.ssh_args)
+        argv.extend([ variables.get('ansible_ssh_host', host), command ])
+        return argv
+
+
+TRANSPORTS = {
+    'local': LocalTransport,
+    'ssh': SSHTransport,
+}
+
+
+def argv_command(args):
+    """Return shell command running args without shell processing
+
+    Arguments are split like the ansible command module splits them, and
+    each argument is quoted, so the shell does not expand globs, variables or
+    redirections in them.
+
+    Raises RunnerError if args can't be split.
+    """
+    try:
+        argv = shlex.split(args)
+    except ValueError, emsg:
+        raise RunnerError('Error parsing command arguments %s: %s' % (args, emsg))
+    if not argv:
+        raise RunnerError('No command to run')
+    return ' '.join(pipes.quote(arg) for arg in argv)
+
+
+def sudo_command(command, sudo_user):
+    """Return command wrapped to run with non-interactive sudo as sudo_user"""
+    return 'sudo -n -u %s /bin/sh -c %s' % (pipes.quote(sudo_user), pipes.quote(command))
+
+
+def get_transport(name, **kwargs):
+    """Return transport
+
+    Return transport for name. SSHTransport accepts keyword arguments.
+
+    Raises RunnerError if transport is unknown.
+    """
+    if name not in TRANSPORTS:
+        raise RunnerError('Unknown transport: %s' % name)
+    if name == 'ssh':
+        return SSHTransport(**kwargs)
+    return TRANSPORTS[name]()